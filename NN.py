@@ -1,5 +1,6 @@
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.ops.parallel_for.gradients import jacobian
 from tensorflow.examples.tutorials.mnist import input_data
 import linecache
 import copy
@@ -128,6 +129,7 @@ class CNN(object):
         self.x = x
         self.layer_type = []
         self.name = name
+        self.layer_dict = layer_dict
         
         self.keep_prob = tf.placeholder(
             tf.float32, name='keep_prob')
@@ -141,6 +143,7 @@ class CNN(object):
         # creating the network's variables
         self.var_dict = {}
         layer_names = list(layer_dict.keys())
+        self.layer_names = layer_names
 
         self.probes = []
         with tf.name_scope(name):
@@ -167,6 +170,11 @@ class CNN(object):
                 # dropping out the output layers if the layer
                 # is in the list of dropped-out layers
                 if i in self.dropout_layers:
+                    # the deterministic part of the network
+                    # ends before the first dropout 
+                    # (see `add_MC_head`)
+                    if i==min(self.dropout_layers):
+                        self.trunk_output = self.output
                     self.output = tf.nn.dropout(
                         self.output, self.keep_prob)
                 
@@ -618,8 +626,13 @@ class CNN(object):
         self.prediction = tf.argmax(
             self.posteriors, 0, name='prediction')
         
-    def get_gradients(self, grad_layers=[]):
+    def get_gradients(self, grad_layers=[], shrink_method=None):
         """Forming gradients of the log-posteriors
+
+        If `shrink_method` (`'sum'` or `'max'`) is given,
+        the gradients shrunk inside the graph (see
+        `NNAL_tools.shrink_gradient_ops`) will also be
+        stored in `self.shrunk_grad_posts`.
         """
         
         # collect all the trainable variabels
@@ -643,7 +656,72 @@ class CNN(object):
                     gpars, name='score_class_%d'% j)
              }
             )
-        
+
+        if shrink_method is not None:
+            self.shrunk_grad_posts = {
+                str(j): NNAL_tools.shrink_gradient_ops(
+                    self.grad_posts[str(j)], shrink_method)
+                for j in range(c)}
+        
+    def get_batch_gradients(self, grad_layers=[], use_pfor=True,
+                            shrink_method=None):
+        """Forming per-sample gradients of the log-posteriors
+        for a whole batch of inputs
+
+        The output `self.batch_grad_posts` has the same
+        structure as `self.grad_posts`, except that each
+        gradient has an extra leading axis whose i-th
+        element is the gradient of the log-posterior of
+        the i-th sample in the batch (i.e., equal to what
+        `self.grad_posts` gives when fed with that sample
+        alone).
+
+        :Parameters:
+
+            **grad_layers** : list of strings
+                layers whose parameters are considered
+                (all the trainable variables if empty)
+
+            **use_pfor** : boolean (default: True)
+                if True, the per-sample gradients will be
+                vectorized across the batch (`pfor`),
+                otherwise they are computed within a
+                `tf.while_loop` over the samples, which
+                takes less memory
+
+            **shrink_method** : string (default: None)
+                if given (`'sum'` or `'max'`), the per-sample
+                gradients shrunk inside the graph will also
+                be stored in `self.shrunk_batch_grad_posts`
+                as `b x A_size` tensors (see
+                `NNAL_tools.shrink_gradient_ops`)
+        """
+
+        if len(grad_layers)==0:
+            gpars = tf.trainable_variables()
+        else:
+            gpars = []
+            for layer in grad_layers:
+                gpars += self.var_dict[layer]
+
+        self.batch_grad_posts = {}
+        c = self.output.get_shape()[0].value
+        for j in range(c):
+            with tf.name_scope('batch_score_class_%d'% j):
+                self.batch_grad_posts.update(
+                    {str(j): jacobian(
+                        tf.log(self.posteriors[j, :]),
+                        gpars, use_pfor=use_pfor)
+                 }
+                )
+
+        if shrink_method is not None:
+            self.shrunk_batch_grad_posts = {
+                str(j): NNAL_tools.shrink_gradient_ops(
+                    self.batch_grad_posts[str(j)],
+                    shrink_method, batch=True)
+                for j in range(c)}
+
     def train_graph_one_epoch(self, expr,
                               train_inds,
                               session,
@@ -1214,6 +1292,244 @@ class AlexNet_CNN(AlexNet):
 
         return predicts
 
+class IndexFedInput(object):
+    """Class of model inputs whose patches are
+    gathered inside the graph
+    
+    The padded volumes (all modalities of all
+    images) are kept in a single non-trainable
+    variable, and the input tensor `x` is built
+    by gathering patches around a batch of voxels
+    whose indices are fed through integer
+    placeholders. Hence, only a few integers per
+    sample are transferred into the session at 
+    each iteration, instead of the patches 
+    themselves.
+
+    The tensor `x` can be used in place of the 
+    input placeholder of any model, e.g. the
+    one created by `create_model` (by passing
+    this object as `input_volumes`) or
+    `NN_extended.CNN`.
+
+    The volumes are normalized once, when they
+    are loaded into the graph, using the given
+    intensity statistics.
+    """
+
+    def __init__(self, 
+                 all_padded_imgs,
+                 patch_shape,
+                 stats):
+        """
+        :Parameters:
+
+            **all_padded_imgs** : list of lists of arrays
+                padded volumes in format `[[I_11,...,I_1M],
+                ..., [I_S1,...,I_SM]]`, where `I_ij` is the
+                j-th modality of the i-th image; all
+                modalities of the same image should have
+                the same shape
+
+            **patch_shape** : tuple of three integers
+                shape of the patches (per modality)
+
+            **stats** : list of lists of pairs
+                mean and standard deviation of the 
+                intensities of each modality of each
+                image, `stats[i][j]=(mu_ij,sigma_ij)`
+        """
+
+        self.patch_shape = tuple(patch_shape)
+        self.rads = np.array([int((patch_shape[i]-1)/2.) 
+                              for i in range(3)])
+        self.m = len(all_padded_imgs[0])
+        d1,d2,d3 = self.patch_shape
+
+        # flattening all the volumes into a buffer
+        # of shape (N,m), with N the total number of
+        # padded voxels
+        self.padded_shapes = [imgs[0].shape for 
+                              imgs in all_padded_imgs]
+        vols = [np.prod(shape) for shape in self.padded_shapes]
+        self.offsets = np.append(0, np.cumsum(vols)[:-1])
+        if np.sum(vols) > np.iinfo(np.int32).max:
+            raise ValueError('Total size of the volumes is '+
+                             'too large for int32 indexing.')
+
+        self.buffer = np.zeros((np.sum(vols), self.m),
+                               dtype=np.float32)
+        for i, imgs in enumerate(all_padded_imgs):
+            for j in range(self.m):
+                self.buffer[self.offsets[i]:
+                            self.offsets[i]+vols[i], j] = (
+                                np.ravel(imgs[j])-stats[i][j][0]
+                            )/stats[i][j][1]
+
+        # relative (flat) indices of the voxels of a 
+        # patch with respect to its corner, one row
+        # for each image
+        grid = np.meshgrid(np.arange(d1), np.arange(d2),
+                           np.arange(d3), indexing='ij')
+        rel_inds = np.zeros((len(all_padded_imgs), d1*d2*d3),
+                            dtype=np.int32)
+        for i, shape in enumerate(self.padded_shapes):
+            rel_inds[i,:] = np.ravel_multi_index(
+                grid, shape).ravel()
+
+        with tf.name_scope('index_fed_input'):
+            # the variable is initialized by feeding the
+            # volumes (rather than a constant) to keep them
+            # out of the graph definition; it is also kept
+            # out of the global collections, so that the
+            # usual initializers and savers skip it
+            self.buffer_init = tf.placeholder(
+                tf.float32, self.buffer.shape)
+            self.volumes = tf.Variable(self.buffer_init,
+                                       trainable=False,
+                                       collections=[],
+                                       name='volumes')
+            rel_inds = tf.constant(rel_inds)
+
+            # integer inputs: image index and (flat) 
+            # index of the patch corner in the buffer
+            self.img_inds = tf.placeholder(
+                tf.int32, [None], name='img_inds')
+            self.corner_inds = tf.placeholder(
+                tf.int32, [None], name='corner_inds')
+
+            patch_inds = tf.expand_dims(
+                self.corner_inds, 1) + tf.gather(
+                    rel_inds, self.img_inds)
+            patches = tf.gather(self.volumes, patch_inds)
+            # (b,d1,d2,d3,m) --> (b,d1,d2,m*d3), with
+            # modalities in the same order as in
+            # `patch_utils.get_patches`
+            patches = tf.reshape(patches, [-1,d1,d2,d3,self.m])
+            patches = tf.transpose(patches, [0,1,2,4,3])
+            self.x = tf.reshape(patches, [-1,d1,d2,self.m*d3],
+                                name='input')
+
+    def load(self, session):
+        """Loading the volumes into the graph
+        variable; should be called once after 
+        creating the session (and before 
+        finalizing the graph)
+        """
+
+        session.run(self.volumes.initializer,
+                    feed_dict={self.buffer_init: self.buffer})
+        # the host copy is not needed anymore
+        self.buffer = None
+
+    def get_feed_dict(self, img_inds, vox_inds):
+        """Preparing the feed-dictionary of the
+        integer inputs for a batch of voxels 
+
+        :Parameters:
+
+            **img_inds** : array of integers
+                index of the image of each voxel
+
+            **vox_inds** : array of integers
+                (unpadded) 3D indices of the voxels
+                in their images
+        """
+
+        img_inds = np.array(img_inds, dtype=int)
+        vox_inds = np.array(vox_inds, dtype=int)
+        corner_inds = np.zeros(len(vox_inds), dtype=np.int32)
+        for i in np.unique(img_inds):
+            locs = img_inds==i
+            img_shape = tuple(np.array(
+                self.padded_shapes[i])-2*self.rads)
+            # the center of a patch in the original 
+            # image is its corner in the padded image
+            multinds = np.unravel_index(
+                vox_inds[locs], img_shape)
+            corner_inds[locs] = np.ravel_multi_index(
+                multinds, self.padded_shapes[i]) + \
+                self.offsets[i]
+
+        return {self.img_inds: img_inds.astype(np.int32),
+                self.corner_inds: corner_inds}
+
+
+def add_MC_head(model, T):
+    """Adding a Monte-Carlo dropout head to a 
+    model, which runs `T` stochastic passes in 
+    a single evaluation
+
+    The layers before the first dropped-out 
+    layer are deterministic, hence their output
+    (`model.trunk_output`) is computed only once
+    and is tiled `T` times through the rest of the
+    network (the head), sharing the same variables.
+    The head should consist of only fully-connected
+    layers (with no batch normalization or skip
+    connections), which is the case when dropout
+    is used only in the last layers.
+
+    The created node `model.MC_posteriors` has 
+    shape `(c, T, b)`, with `c` the number of
+    classes and `b` the size of the batch. It works
+    with both `CNN` and `NN_extended.CNN` models.
+    """
+
+    if len(model.dropout_layers)==0:
+        raise ValueError('The model does not have any '+
+                         'dropped-out layer.')
+    L0 = min(model.dropout_layers)
+    if len(model.trunk_output.shape)!=2:
+        raise ValueError('The first dropped-out layer should '+
+                         'be fully-connected.')
+    if hasattr(model, 'skips') and np.any(
+            [np.max(skip[1])>L0 for skip in model.skips]):
+        raise ValueError('Skip connections in the stochastic '+
+                         'part of the model are not supported.')
+
+    nlayers = len(model.layer_names)
+    with tf.name_scope(model.name+'_MC_head'):
+        # samples in format (features, T*b), where
+        # the t-th tile is the t-th pass
+        output = tf.tile(model.trunk_output, [1, T])
+        for i in range(L0, nlayers):
+            if i>L0:
+                layer_name = model.layer_names[i]
+                if hasattr(model, 'layer_type'):
+                    # `CNN` models: relu except for
+                    # the last layer
+                    layer_type = model.layer_type[i]
+                    ops = 'MA' if i<nlayers-1 else 'M'
+                else:
+                    layer = model.layer_dict[layer_name]
+                    layer_type = layer[0]
+                    ops = layer[2] if len(layer)>2 else 'M'
+                if layer_type!='fc' or 'B' in ops:
+                    raise ValueError('Layer %s of the stochastic '% 
+                                     layer_name + 'part should be '+
+                                     'fully-connected with no '+
+                                     'batch normalization.')
+                for op in ops:
+                    if op=='M':
+                        W, b = model.var_dict[layer_name][-2:]
+                        output = tf.matmul(W, output) + b
+                    elif getattr(model, 'activation', 'ReLU')=='tanh':
+                        output = tf.nn.tanh(output)
+                    else:
+                        output = tf.nn.relu(output)
+
+            if i in model.dropout_layers:
+                output = tf.nn.dropout(output, model.keep_prob)
+
+        c = output.get_shape()[0].value
+        posteriors = tf.transpose(
+            tf.nn.softmax(tf.transpose(output)))
+        model.MC_posteriors = tf.reshape(
+            posteriors, [c, T, -1], name='MC_posteriors')
+    model.MC_T = T
+
+
 def create_model(model_name,
                  dropout_rate, 
                  nclass,
@@ -1221,7 +1537,8 @@ def create_model(model_name,
                  grad_layers=[],
                  train_layers=[],
                  optimizer_name='SGD',
-                 patch_shape=None):
+                 patch_shape=None,
+                 input_volumes=None):
     
     if model_name=='Alex':
         model = create_Alex(dropout_rate, 
@@ -1240,7 +1557,8 @@ def create_model(model_name,
                             dropout_rate,
                             learning_rate,
                             optimizer_name,
-                            patch_shape)
+                            patch_shape,
+                            input_volumes)
         
     return model
 
@@ -1320,9 +1638,15 @@ def create_PW1(nclass,
                dropout_rate,
                learning_rate,
                optimizer_name,
-               patch_shape):
+               patch_shape,
+               input_volumes=None):
     """Creating a model for patch-wise
     segmentatio of medical images
+
+    If `input_volumes` (an `IndexFedInput`
+    object) is given, its in-graph patches
+    will be used as the input of the model
+    instead of a placeholder.
     """
 
     pw_dict = {'conv1':[24, 'conv', [5,5]],
@@ -1336,13 +1660,16 @@ def create_PW1(nclass,
                'fc3':[nclass,'fc']}
     
     dropout = [[6,7,8], dropout_rate]
-    x = tf.placeholder(
-        tf.float32,
-        [None, 
-         patch_shape[0],
-         patch_shape[1],
-         patch_shape[2]],
-        name='input')
+    if input_volumes is None:
+        x = tf.placeholder(
+            tf.float32,
+            [None, 
+             patch_shape[0],
+             patch_shape[1],
+             patch_shape[2]],
+            name='input')
+    else:
+        x = input_volumes.x
     feature_layer = len(pw_dict) - 2
     probes = [5]
     
@@ -1350,6 +1677,7 @@ def create_PW1(nclass,
     model = CNN(x, pw_dict, 'PatchWise', 
                 feature_layer, 
                 dropout, probes)
+    model.input_volumes = input_volumes
     # optimizers
     model.get_optimizer(learning_rate, [],
                         optimizer_name)
@@ -9,6 +9,7 @@ import os
 
 import NN
 import NNAL_tools
+import sim_utils
 from cvxopt import matrix, solvers
 
 read_file_path = "/home/ch194765/repos/atlas-active-learning/AlexNet/"
@@ -492,33 +493,18 @@ def CNN_query(model,
         F = model.extract_features(pool_inds, 
                                    expr,
                                    session)
-        F_uncertain = F[:, sel_inds]
-        norms_uncertain = np.sqrt(np.sum(F_uncertain**2, axis=0))
-        F_rem_pool = F[:, rem_inds]
-        norms_rem = np.sqrt(np.sum(F_rem_pool**2, axis=0))
+        X_uncertain = sim_utils.normalize_features(F[:, sel_inds])
+        X_rem_pool = sim_utils.normalize_features(F[:, rem_inds])
         
         # compute cos-similarities between filtered images
         # and the rest of the unlabeled samples
-        dots = np.dot(F_rem_pool.T, F_uncertain)
-        norms_outer = np.outer(norms_rem, norms_uncertain)
-        sims = dots / norms_outer
+        sims = sim_utils.cosine_sims(X_rem_pool, X_uncertain)
             
         print("Greedy optimization..", end='\n\t')
-        # start from empty set
-        Q_inds = []
-        nQ_inds = np.arange(B)
         # add most representative samples one by one
-        for i in range(k):
-            rep_scores = np.zeros(B-i)
-            for j in range(B-i):
-                cand_Q = Q_inds + [nQ_inds[j]]
-                rep_scores[j] = np.sum(
-                    np.max(sims[:, cand_Q], axis=1))
-            iter_sel = nQ_inds[np.argmax(rep_scores)]
-            # update the iterating sets
-            Q_inds += [iter_sel]
-            nQ_inds = np.delete(
-                nQ_inds, np.argmax(rep_scores))
+        lazy = 'lazy_rep' in expr.pars and expr.pars['lazy_rep']
+        Q_inds = NNAL_tools.FacilityLocation(sims).select(
+            k, lazy)
             
         Q_inds = sel_inds[Q_inds]
 
@@ -2,11 +2,14 @@ import warnings
 import numpy as np
 import tensorflow as tf
 from tensorflow.examples.tutorials.mnist import input_data
-from cvxopt import matrix, solvers
+from cvxopt import matrix, spmatrix, sparse, solvers
 import cvxpy as cvx
+from scipy.linalg import solve_triangular
 solvers.options['show_progress'] = False
 import pdb
 import sys
+import heapq
+import time
 import copy
 import h5py
 #import cv2
@@ -18,6 +21,7 @@ read_file_path = "/home/ch194765/repos/atlas-active-learning/"
 sys.path.insert(0, read_file_path)
 #import prep_dat
 import patch_utils
+import sim_utils
 
 def uncertainty_filtering(posteriors, B):
     """Filtering data by keeping only the most `B` uncertain
@@ -35,7 +39,208 @@ def uncertainty_filtering(posteriors, B):
     
     return selected_unlabeled
 
-def enlist_gradients(TF_vars, B, par_list):
+class FacilityLocation(object):
+    """Greedy selection of the most representative
+    candidates, that is maximizing the facility 
+    location objective
+
+        f(Q) = sum_i max_{j in Q} sims[i,j]
+
+    where rows of the similarity matrix `sims` are
+    the samples to be represented (e.g. the pool)
+    and its columns are the candidates (e.g. the 
+    most uncertain samples).
+
+    The running maximum similarity of the rows to
+    the selected set is kept, hence the objective 
+    of adding each candidate is evaluated with one
+    vectorized pass over `sims`. The columns are
+    processed in blocks of at most `max_bytes` bytes, 
+    so `sims` can also be a memory-mapped array 
+    that does not fit in the memory. The objectives
+    are summed exactly as in our original greedy
+    loop, hence the selections are identical (among
+    equal objectives the smallest candidate index
+    is chosen).
+
+    With `lazy=True`, the marginal gains from the
+    previous steps are used as upper bounds of the
+    current ones (because of submodularity) in a 
+    priority queue, and only the candidates whose
+    bounds could reach the best objective (up to a
+    tolerance for the round-off errors) are 
+    evaluated in each step.
+    """
+
+    def __init__(self, sims, max_bytes=2**28):
+
+        self.sims = sims
+        self.n, self.B = sims.shape
+        self.block_size = max(1, int(max_bytes / (16*max(self.n,1))))
+
+        # running maximum similarities to the 
+        # selected set (none selected yet)
+        self.max_sims = -np.inf*np.ones(self.n)
+        self.selected = []
+
+    def objectives(self, cands):
+        """Objective of adding each of the given 
+        candidates to the current selected set
+        """
+
+        vals = np.zeros(len(cands))
+        for t in range(0, len(cands), self.block_size):
+            block = cands[t:t+self.block_size]
+            # each row of the block is a candidate
+            block_sims = np.ascontiguousarray(
+                np.array(self.sims[:, block]).T)
+            np.maximum(block_sims, self.max_sims, out=block_sims)
+            vals[t:t+self.block_size] = np.sum(block_sims, axis=1)
+
+        return vals
+
+    def add(self, j):
+        """Adding candidate `j` to the selected set
+        """
+
+        self.max_sims = np.maximum(
+            self.max_sims, np.array(self.sims[:, j]))
+        self.selected += [j]
+
+    def select(self, k, lazy=False):
+        """Selecting `k` candidates greedily, returned
+        in the order of their selection
+        """
+
+        k = min(k, self.B - len(self.selected))
+        if lazy:
+            self.lazy_select(k)
+            return self.selected
+
+        rem = np.setdiff1d(np.arange(self.B), self.selected)
+        for t in range(k):
+            vals = self.objectives(rem)
+            j = np.argmax(vals)
+            self.add(rem[j])
+            rem = np.delete(rem, j)
+
+        return self.selected
+
+    def lazy_select(self, k):
+        """Lazy greedy selection of `k` candidates
+        (see the class description)
+        """
+
+        if k<=0:
+            return
+
+        # the objective of the empty set is taken
+        # as if all rows were represented by the
+        # smallest similarity, so that the gains
+        # are non-negative and diminishing
+        base = np.inf
+        for t in range(0, self.B, self.block_size):
+            base = min(base, np.min(
+                self.sims[:, t:t+self.block_size]))
+        curr_obj = np.sum(np.maximum(self.max_sims, base))
+        tol = 1e-12*max(self.n, 1)
+
+        rem = np.setdiff1d(np.arange(self.B), self.selected)
+        vals = self.objectives(rem)
+        heap = [(-(vals[t]-curr_obj), rem[t]) for t in range(len(rem))]
+        heapq.heapify(heap)
+
+        for t in range(k):
+            best_val = -np.inf
+            best_j = None
+            evaluated = []
+            while len(heap)>0:
+                neg_gain, j = heap[0]
+                if best_j is not None and \
+                   curr_obj - neg_gain < best_val - tol:
+                    break
+                heapq.heappop(heap)
+                val = self.objectives(np.array([j]))[0]
+                evaluated += [(val, j)]
+                if val>best_val or (val==best_val and j<best_j):
+                    best_val = val
+                    best_j = j
+
+            self.add(best_j)
+            # gains w.r.t. the previous set bound
+            # the gains w.r.t. the new one
+            for val, j in evaluated:
+                if j!=best_j:
+                    heapq.heappush(heap, (-(val-curr_obj), j))
+            curr_obj = best_val
+
+
+class KCenterGreedy(object):
+    """Greedy k-center (core-set) selection based on
+    cosine distances `1 - cos(x,y)`
+
+    Features of the pool are given as the rows of a
+    pre-normalized float32 array (see 
+    `sim_utils.normalize_features`), and a single
+    vector of the minimum distance of each pool
+    sample to the centers is kept. The centers can
+    be samples out of the pool (e.g. the labeled
+    ones, added through `add_centers`) and the
+    selected samples, where each newly added one is
+    compared only against the pool. Distances to the
+    centers out of the pool are computed by 
+    `sim_utils.reduce_sims` in blocks of at most
+    `max_bytes` bytes, with `n_threads` threads.
+
+    The vector `min_dists` can be saved and set 
+    again to skip the (usually expensive) distances
+    to the labeled samples.
+    """
+
+    def __init__(self, X, max_bytes=2**28, n_threads=1):
+
+        self.X = X
+        self.n = X.shape[0]
+        self.max_bytes = max_bytes
+        self.n_threads = n_threads
+        self.min_dists = np.inf*np.ones(self.n, dtype=np.float32)
+        self.selected = []
+
+    def add_centers(self, C):
+        """Adding centers out of the pool, whose 
+        normalized features are the rows of `C`
+        """
+
+        max_sims = sim_utils.reduce_sims(
+            self.X, C, max_bytes=self.max_bytes,
+            n_threads=self.n_threads)
+        np.minimum(self.min_dists, 1. - max_sims,
+                   out=self.min_dists)
+
+    def add(self, j):
+        """Adding the `j`-th pool sample as a center
+        """
+
+        dists = 1. - np.dot(self.X, self.X[j])
+        np.minimum(self.min_dists, dists, out=self.min_dists)
+        # selected samples will be ignored
+        self.min_dists[j] = -np.inf
+        self.selected += [j]
+
+    def select(self, k):
+        """Selecting `k` pool samples greedily (the 
+        farthest one from the centers in each step),
+        returned in the order of their selection
+        """
+
+        k = min(k, self.n - len(self.selected))
+        for t in range(k):
+            self.add(np.argmax(self.min_dists))
+
+        return self.selected
+
+
+def enlist_gradients(TF_vars, B, par_list, shrink_method=None):
     """Take a TensorFlow variable, which contains several cost function
     (with possibly variable size), and unstack them and create a list of
     their gradients so that they can be calculated in a single call of
@@ -48,7 +253,10 @@ def enlist_gradients(TF_vars, B, par_list):
     for `TF_vars` in the time of running. 
     
     The function should get the list of parameters with respect to which
-    the gradients are to be taken too.
+    the gradients are to be taken too. If `shrink_method` (`'sum'` or
+    `'max'`) is given, each gradient will be shrunk inside the graph
+    (see `shrink_gradient_ops`) and hence be a single tensor, instead of
+    a list of gradients of all the parameters.
     """
     
     # extract number of classes
@@ -65,6 +273,9 @@ def enlist_gradients(TF_vars, B, par_list):
     # forming the list of gradients
     funcs = np.reshape(vars_array, c*B)
     grads = [tf.gradients(func, par_list) for func in funcs]
+    if shrink_method is not None:
+        grads = [shrink_gradient_ops(grad, shrink_method)
+                 for grad in grads]
     
     return grads
 
@@ -620,7 +831,7 @@ def SDP_query_distribution(A, lambda_, X_pool, k):
     """Preparing the variables"""
 
     # matrix inequality constraints
-    G, h = inequality_cvx_matrix(A)
+    G, h, Gl, hl = inequality_cvx_matrix(A)
     # equality constraint (for having probabilities)
     if lambda_>0:
         d = X_pool.shape[0]
@@ -654,10 +865,171 @@ def SDP_query_distribution(A, lambda_, X_pool, k):
     
     
     """Solving SDP"""
-    soln = solvers.sdp(cvec, Gs=G, hs=h, A=A_eq, b=b_eq)
+    soln = solvers.sdp(cvec, Gl=Gl, hl=hl, Gs=G, hs=h,
+                       A=A_eq, b=b_eq)
     
     return soln
 
+def first_order_query_distribution(A,
+                                   I_U=None,
+                                   q0=None,
+                                   method='FW',
+                                   max_iters=1000,
+                                   time_limit=None,
+                                   gap_tol=1e-4):
+    """Minimizing `tr((sum_i q_i A_i)^-1 I_U)` over the
+    probability simplex by first-order methods, as an
+    alternative to the SDP solvers of FIR-based active
+    learning (`SDP_query_distribution`, `solve_FIAL_SDP`)
+
+    The gradient with respect to `q_i` is 
+    `-tr(A_i S^-1 I_U S^-1)`, with `S = sum_i q_i A_i`, and
+    it is evaluated for all the candidates through the
+    Cholesky factor of `S`. The Frank-Wolfe duality gap 
+    `g^T q - min_i g_i`, which bounds the sub-optimality of
+    the objective, is computed at each iteration.
+
+    :Parameters:
+
+        **A** : list of 2D arrays
+            (positive-definite) A-matrices of the candidates
+
+        **I_U** : 2D array (default: None)
+            Fisher information of the pool; the identity
+            matrix is used if not given (i.e., the same
+            objective as `SDP_query_distribution` with
+            `lambda_=0`)
+
+        **q0** : 1D array (default: None)
+            initial query distribution (warm start); the
+            uniform distribution is used if not given
+
+        **method** : string (default: `'FW'`)
+            either `'FW'` for (pairwise) Frank-Wolfe
+            iterations with exact line-search, or `'MD'` for
+            mirror descent (exponentiated gradient) iterations
+
+        **max_iters** : integer (default: 1000)
+            maximum number of iterations
+
+        **time_limit** : float (default: None)
+            maximum running time (in seconds)
+
+        **gap_tol** : float (default: 1e-4)
+            the iterations stop when the duality gap
+            is smaller than `gap_tol` times the objective
+
+    :Returns:
+
+        **q** : 1D array
+            the (best) query distribution
+
+        **info** : dictionary
+            with keys `'objective'`, `'gap'`, `'iters'`
+            (number of the steps taken) and `'status'`
+            (`'optimal'`, `'max_iters'` or `'time_limit'`)
+    """
+
+    if method not in ['FW', 'MD']:
+        raise ValueError("Method should be either 'FW' or 'MD'.")
+
+    t0 = time.time()
+    A = np.array(A, dtype=float)
+    n, d = A.shape[:2]
+    A_vec = A.reshape(n, d*d)
+    if I_U is None:
+        I_U = np.eye(d)
+
+    if q0 is None:
+        q = np.ones(n)/n
+    else:
+        q = np.array(q0, dtype=float)
+        q[q<0] = 0.
+        q /= np.sum(q)
+        if method=='MD':
+            # mirror descent can not revive zero masses
+            q = .99*q + .01/n
+
+    def evaluate(q):
+        # objective and gradient at q
+        S = np.dot(q, A_vec).reshape(d,d)
+        L_inv = solve_triangular(np.linalg.cholesky(S),
+                                 np.eye(d), lower=True)
+        S_inv = np.dot(L_inv.T, L_inv)
+        M = np.dot(np.dot(S_inv, I_U), S_inv)
+        obj = np.sum(S_inv * I_U)
+        grad = -np.dot(A_vec, np.ravel(M))
+        return obj, grad, S, L_inv
+
+    best = (np.inf, q, np.inf)
+    status = 'max_iters'
+    # number of the (completed) steps
+    iters = 0
+    for t in range(max_iters):
+        obj, grad, S, L_inv = evaluate(q)
+        s = np.argmin(grad)
+        gap = np.dot(grad, q) - grad[s]
+        if obj < best[0]:
+            best = (obj, q, gap)
+        if gap <= gap_tol*obj:
+            best = (obj, q, gap)
+            status = 'optimal'
+            break
+        if time_limit is not None and time.time()-t0 > time_limit:
+            status = 'time_limit'
+            break
+
+        if method=='FW':
+            # pairwise step, moving mass from the worst
+            # candidate in the support (a) to the best
+            # one (s), with exact line-search: with
+            # lambda's the eigenvalues of 
+            # L^-1 (A_s - A_a) L^-T, the objective along
+            # this direction is sum_k w_k/(1 + gamma lambda_k)
+            supp = np.where(q>0)[0]
+            a = supp[np.argmax(grad[supp])]
+            gamma_max = q[a]
+            lambdas, V = np.linalg.eigh(
+                np.dot(np.dot(L_inv, A[s]-A[a]), L_inv.T))
+            LV = np.dot(L_inv.T, V)
+            w = np.sum(LV * np.dot(I_U, LV), axis=0)
+            dobj = lambda gamma: -np.sum(
+                w*lambdas/(1.+gamma*lambdas)**2)
+            if dobj(gamma_max) <= 0:
+                gamma = gamma_max
+            else:
+                lo, hi = 0., gamma_max
+                for _ in range(50):
+                    gamma = (lo+hi)/2.
+                    if dobj(gamma) > 0:
+                        hi = gamma
+                    else:
+                        lo = gamma
+            q = q.copy()
+            q[s] += gamma
+            q[a] -= gamma
+            if gamma==gamma_max:
+                q[a] = 0.
+        else:
+            # exponentiated gradient step (in log-domain)
+            eta = 1./(np.max(np.abs(grad))*np.sqrt(t+1))
+            logq = np.log(q) - eta*grad
+            q = np.exp(logq - np.max(logq))
+            q /= np.sum(q)
+        iters += 1
+    else:
+        obj, grad, _, _ = evaluate(q)
+        gap = np.dot(grad, q) - np.min(grad)
+        if obj < best[0]:
+            best = (obj, q, gap)
+        if gap <= gap_tol*obj:
+            status = 'optimal'
+
+    info = {'objective': best[0], 'gap': best[2],
+            'iters': iters, 'status': status}
+
+    return best[1], info
+
 def inequality_cvx_matrix(A, k=None):
     """Preparing inequality vectorized matrices needed
     to form the SDP of FIR-based active learning
@@ -670,6 +1042,14 @@ def inequality_cvx_matrix(A, k=None):
     array once we want to covnert them into cvxopt
     matrix.
 
+    The matrix inequalities are built as sparse
+    matrices that contain only the lower-triangular
+    part of the constraints (the only part that is
+    read by cvxopt), and positivity of the query
+    PMF is expressed by linear inequalities. The
+    outputs are the matrix inequalities (`G`, `h`)
+    and the linear ones (`Gl`, `hl`).
+
     If `k` is given, it means that an extra constraint
     should be applied to prevent the query PMF from 
     becoming too peaky (degenerate distributin)
@@ -678,46 +1058,46 @@ def inequality_cvx_matrix(A, k=None):
     n = len(A)
     d = A[0].shape[0]
     
-    # first form matrices that include A:
-    # forming the rows in constraint matrix
-    # corresponding to q_i's, since these remain
-    # unchagned through all the first d constraints
-    # can can be formed only once
-    unchanged_arr = np.zeros((n, (d+1)**2))
-    # also compute the part related to positivity
-    # constraint in this same loop
-    positivity_const = np.zeros((n+d, n**2))
-    for i in range(n):
-        app_A = append_zero(A[i])
-        unchanged_arr[i,:] = np.ravel(app_A.T)
-        positivity_const[i, i*n+i] = 1.
-        
+    # first form the entries that include A:
+    # the columns corresponding to q_i's remain
+    # unchanged through all the d constraints
+    # and can be formed only once (the matrices
+    # are padded by a zero row and column, and
+    # vectorized column-wise)
+    rows, cols = np.tril_indices(d)
+    G_I = np.tile(cols*(d+1) + rows, n).tolist()
+    G_J = np.repeat(np.arange(n), len(rows)).tolist()
+    G_V = (-np.array([A[i][rows, cols] for i in range(n)],
+                     dtype=float).ravel()).tolist()
+    G_I += [(d+1)**2-1]
+    G_V += [-1.]
+
     # we should also construct the right-hand-side
     # of the inequality constraints (h's)
     h = []
     G = []
     for j in range(d):
-        ineq_arr = np.zeros((n+d, (d+1)**2))
-        ineq_arr[:n,:] = unchanged_arr
-        # matrix for t_j
-        ineq_arr[n+j,-1] = 1.
-        G += [matrix(-ineq_arr.T)]
+        # the last entry for t_j
+        G += [spmatrix(G_V, G_I, G_J + [n+j],
+                       ((d+1)**2, n+d))]
         # the corresponding h-term
         h_mat = np.zeros((d+1, d+1))
-        h_mat[j, -1] = -1.
-        h_mat[-1, j] = -1.
-        h += [matrix(-h_mat)]
+        h_mat[j, -1] = 1.
+        h_mat[-1, j] = 1.
+        h += [matrix(h_mat)]
         
     # Also, include the positivity constraints
-    G += [matrix(-positivity_const.T)]
-    h += [matrix(np.zeros((n, n)))]
+    # (-q_i <= 0)
+    Gl = spmatrix(-1., range(n), range(n), (n, n+d))
+    hl = matrix(np.zeros(n))
     
     # add q_i <= 1/k if k is given
     if k:
-        G += [matrix(positivity_const.T)]
-        h += [matrix(np.eye(n)/np.float(k))]
+        Gl = sparse([Gl, spmatrix(1., range(n), range(n), (n, n+d))])
+        hl = matrix(np.concatenate((np.zeros(n),
+                                    np.ones(n)/float(k))))
     
-    return G, h
+    return G, h, Gl, hl
 
 
     
@@ -830,6 +1210,64 @@ def shrink_gradient(grad, method, args=None):
                 
     return np.ravel(shrunk_grad)
 
+def shrink_gradient_ops(grad, method, batch=False):
+    """Forming the shrinking of `shrink_gradient` inside
+    the graph, such that only the reduced gradient vectors
+    need to be fetched from TensorFlow
+
+    Only `'sum'` and `'max'` methods are supported. The
+    input `grad` is a list of gradient tensors (weights
+    and bias of each layer, similar to `shrink_gradient`).
+    If `batch` is True, the first axis of all the tensors
+    is assumed to index the samples (such as the output
+    of `NN.CNN.get_batch_gradients`), and the output will
+    be a `b x A_size` tensor, otherwise it will be a
+    tensor of length `A_size`.
+    """
+
+    if method not in ['sum', 'max']:
+        raise ValueError("Only 'sum' and 'max' shrinking " +
+                         "methods can be formed in the graph.")
+
+    def signed_absmax(gr):
+        # (signed) entry with the largest magnitude
+        # in each row
+        gr_max = tf.reduce_max(gr, axis=1)
+        gr_min = tf.reduce_min(gr, axis=1)
+        return tf.where(gr_max >= -gr_min, gr_max, gr_min)
+
+    layer_num = int(len(grad) / 2)
+    shrunk_grad = []
+    for t in range(layer_num):
+        # flattening the derivatives of each sample
+        if batch:
+            grW = tf.reshape(grad[2*t], [tf.shape(grad[2*t])[0], -1])
+            grb = tf.reshape(grad[2*t+1], [tf.shape(grad[2*t+1])[0], -1])
+        else:
+            grW = tf.reshape(grad[2*t], [1, -1])
+            grb = tf.reshape(grad[2*t+1], [1, -1])
+
+        if method=='sum':
+            # summing up derivatives related to
+            # the parameters of each layer
+            grad_size = np.prod(
+                grad[2*t].get_shape()[int(batch):].as_list()) + \
+                np.prod(grad[2*t+1].get_shape()[int(batch):].as_list())
+            shrunk_grad += [(tf.reduce_sum(grW, axis=1) +
+                             tf.reduce_sum(grb, axis=1))/float(grad_size)]
+        else:
+            # Taking the gradient with maximum
+            # magnitude
+            grW_max = signed_absmax(grW)
+            grb_max = signed_absmax(grb)
+            shrunk_grad += [tf.maximum(grW_max, grb_max)]
+
+    shrunk_grad = tf.stack(shrunk_grad, axis=1)
+    if not(batch):
+        shrunk_grad = shrunk_grad[0,:]
+
+    return shrunk_grad
+
 def append_zero(A):
     """Function for appending zeros as the
     last row and column of a given square matrix
@@ -1,5 +1,6 @@
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.ops.parallel_for.gradients import jacobian
 from tensorflow.examples.tutorials.mnist import input_data
 from sklearn.metrics import f1_score
 from skimage.util import random_noise
@@ -14,6 +15,7 @@ import os
 
 #from eval_utils import eval_metrics
 import PW_NN
+import NNAL_tools
 import AL
 
 
@@ -98,7 +100,10 @@ class CNN(object):
         :Parameters:
         
             **x** : Tensorflow placeholder in format [n_batch, (H, W), n_channel]
-                Input to the network 
+                Input to the network; for an index-fed model, 
+                whose patches are gathered in the graph, pass 
+                the `x` tensor of an `NN.IndexFedInput` object
+                and feed its integer placeholders instead
         
             **layer_dict** : dictionary
                 Information about all layers of the network in format 
@@ -217,6 +222,11 @@ class CNN(object):
                 # dropping out the output if the layer
                 # is in the list of dropped-out layers
                 if i in self.dropout_layers:
+                    # the deterministic part of the network
+                    # ends before the first dropout 
+                    # (see `NN.add_MC_head`)
+                    if i==min(self.dropout_layers):
+                        self.trunk_output = self.output
                     self.output = tf.nn.dropout(
                         self.output, self.keep_prob)
 
@@ -1008,8 +1018,13 @@ class CNN(object):
                 sess.run(self.ema_apply)
             
         
-    def get_gradients(self, grad_layers=[]):
+    def get_gradients(self, grad_layers=[], shrink_method=None):
         """Forming gradients of the log-posteriors
+
+        If `shrink_method` (`'sum'` or `'max'`) is given,
+        the gradients shrunk inside the graph (see
+        `NNAL_tools.shrink_gradient_ops`) will also be
+        stored in `self.shrunk_grad_posts`.
         """
         
         # collect all the trainable variabels
@@ -1033,6 +1048,72 @@ class CNN(object):
                     gpars, name='score_class_%d'% j)
              }
              )
+
+        if shrink_method is not None:
+            self.shrunk_grad_posts = {
+                str(j): NNAL_tools.shrink_gradient_ops(
+                    self.grad_posts[str(j)], shrink_method)
+                for j in range(c)}
+
+    def get_batch_gradients(self, grad_layers=[], use_pfor=True,
+                            shrink_method=None):
+        """Forming per-sample gradients of the log-posteriors
+        for a whole batch of inputs
+
+        The output `self.batch_grad_posts` has the same
+        structure as `self.grad_posts`, except that each
+        gradient has an extra leading axis whose i-th
+        element is the gradient of the log-posterior of
+        the i-th sample in the batch (i.e., equal to what
+        `self.grad_posts` gives when fed with that sample
+        alone).
+
+        :Parameters:
+
+            **grad_layers** : list of strings
+                layers whose parameters are considered
+                (all the trainable variables if empty)
+
+            **use_pfor** : boolean (default: True)
+                if True, the per-sample gradients will be
+                vectorized across the batch (`pfor`),
+                otherwise they are computed within a
+                `tf.while_loop` over the samples, which
+                takes less memory
+
+            **shrink_method** : string (default: None)
+                if given (`'sum'` or `'max'`), the per-sample
+                gradients shrunk inside the graph will also
+                be stored in `self.shrunk_batch_grad_posts`
+                as `b x A_size` tensors (see
+                `NNAL_tools.shrink_gradient_ops`)
+        """
+
+        if len(grad_layers)==0:
+            gpars = tf.trainable_variables()
+        else:
+            gpars = []
+            for layer in grad_layers:
+                gpars += self.var_dict[layer]
+
+        self.batch_grad_posts = {}
+        c = self.output.get_shape()[0].value
+        for j in range(c):
+            with tf.name_scope('batch_score_class_%d'% j):
+                self.batch_grad_posts.update(
+                    {str(j): jacobian(
+                        tf.log(self.posteriors[j, :]),
+                        gpars, use_pfor=use_pfor)
+                 }
+                )
+
+        if shrink_method is not None:
+            self.shrunk_batch_grad_posts = {
+                str(j): NNAL_tools.shrink_gradient_ops(
+                    self.batch_grad_posts[str(j)],
+                    shrink_method, batch=True)
+                for j in range(c)}
+
     def count_parameters(self):
         cnt = 0
         for _,pars in self.var_dict.items():
@@ -1684,6 +1765,10 @@ def replicate_model(model,
 
     If `same_input` flag is set to `True`, the replicated
     model will have the same input as the main model.
+
+    Models of the older `NN.CNN` class can also be
+    replicated; their layers will be re-written in the
+    format of this module (see `convert_NN_layer_dict`).
     """
 
     # main body of the model
@@ -1693,7 +1778,12 @@ def replicate_model(model,
         new_name = new_name[:-2] + '_{}'.format(suffix)
         suffix += 1
 
-    layer_dict = model.layer_dict
+    if isinstance(model, CNN):
+        layer_dict = model.layer_dict
+        skips = model.skips
+    else:
+        layer_dict = convert_NN_layer_dict(model.layer_dict)
+        skips = []
     if same_input:
         x = model.x
     else:
@@ -1705,7 +1795,7 @@ def replicate_model(model,
         for _,input_layer in model.branches_input_layer.items():
             probes[0] += [input_layer]
     
-    rep_model = CNN(x, layer_dict, new_name, model.skips,
+    rep_model = CNN(x, layer_dict, new_name, skips,
                     None, None, probes)
 
     # branches, if any
@@ -1727,6 +1817,104 @@ def replicate_model(model,
     return rep_model
 
 
+def convert_NN_layer_dict(layer_dict):
+    """Re-writing the layer dictionary of an `NN.CNN`
+    model in the format of the `CNN` class of this
+    module, such that both give the same network
+
+    In `NN.CNN` all the convolutional layers, and all
+    the fully-connected layers except the last one,
+    are followed by a ReLU activation.
+    """
+
+    layer_names = list(layer_dict.keys())
+    new_dict = {}
+    for i, name in enumerate(layer_names):
+        specs = layer_dict[name]
+        if specs[1]=='conv':
+            new_dict[name] = ['conv', [specs[0], list(specs[2])], 'MA']
+        elif specs[1]=='fc':
+            op_order = 'M' if i==len(layer_names)-1 else 'MA'
+            new_dict[name] = ['fc', [specs[0]], op_order]
+        elif specs[1]=='pool':
+            # `NN.CNN` pooling specs are [window size, stride]
+            if specs[0][0]!=specs[0][1]:
+                raise ValueError('Pooling layer %s with '% name +
+                                 'different window size and stride ' +
+                                 'cannot be converted.')
+            new_dict[name] = ['pool', list(specs[0]), 'M']
+        else:
+            raise ValueError("Layer's type should be either 'fc'" + 
+                             ", 'conv' or 'pool'.")
+
+    return new_dict
+
+
+class ModelEnsemble(object):
+    """Ensemble of replicas of a model kept in one
+    graph, whose posteriors are stacked such that all
+    the members are evaluated in a single run
+
+    The members share the input of the source model
+    (hence the same feed dictionary, or the in-graph
+    patches of an index-fed model, can be used) and
+    have no dropout. Weights of the members are set
+    either from .h5 files (`load_member`) or from the 
+    current weights of the source model (`copy_member`),
+    e.g. after it is fine-tuned.
+
+    Posteriors of all the members are in the attribute
+    `member_posteriors` with shape `(n_members, c, b)`.
+    """
+
+    def __init__(self, model, n_members):
+        """Constructor takes the source model, that
+        can be either a `CNN` object of this module
+        or an `NN.CNN` object, and the number of
+        members in the ensemble
+
+        It should be called before finalizing the graph.
+        """
+
+        self.n_members = n_members
+        self.x = model.x
+        self.keep_prob = model.keep_prob
+        if hasattr(model, 'input_volumes'):
+            self.input_volumes = model.input_volumes
+
+        self.members = []
+        self.copy_ops = []
+        for j in range(n_members):
+            member = replicate_model(model, same_input=True)
+            member.add_assign_ops()
+            self.members += [member]
+
+            # in-graph copying of the source weights,
+            # which avoids writing them on the disk
+            ops = []
+            for layer_name, layer_vars in model.var_dict.items():
+                for src, dst in zip(layer_vars,
+                                    member.var_dict[layer_name]):
+                    ops += [dst.assign(src)]
+            self.copy_ops += [ops]
+
+        self.member_posteriors = tf.stack(
+            [member.posteriors for member in self.members],
+            name='member_posteriors')
+
+    def load_member(self, j, file_path, sess):
+        """Setting the weights of the `j`-th member
+        from a .h5 file
+        """
+        self.members[j].perform_assign_ops(file_path, sess)
+
+    def copy_member(self, j, sess):
+        """Setting the weights of the `j`-th member
+        to the current weights of the source model
+        """
+        sess.run(self.copy_ops[j])
+
+
 def exists_model_name(name):
     """Check if a model's name already exists
     """
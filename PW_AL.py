@@ -21,6 +21,7 @@ import PW_NNAL
 import PW_NN
 import NNAL
 import NN
+import NN_extended
 
 # avioding TF warnings
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -286,17 +287,13 @@ class Experiment(object):
             rads[i] = int(
                 (self.pars['patch_shape'][i]-1)/2.)
 
-        padded_imgs = []
-        for path in self.pars['img_paths']:
-            img,_ = nrrd.read(path)
-            padded_img = np.pad(
-                img, 
-                ((rads[0],rads[0]),
-                 (rads[1],rads[1]),
-                 (rads[2],rads[2])),
-                'constant')
-            padded_imgs += [padded_img]
-        mask,_ = nrrd.read(self.pars['mask_path'])
+        if 'volume_cache_bytes' in self.pars:
+            patch_utils.volume_cache.set_budget(
+                self.pars['volume_cache_bytes'])
+        padded_imgs = [patch_utils.load_padded_volume(
+            path, rads) for path in self.pars['img_paths']]
+        mask = patch_utils.load_padded_volume(
+            self.pars['mask_path'])
 
         # set up the paths
         method_path = os.path.join(self.root_dir, 
@@ -350,6 +347,17 @@ class Experiment(object):
         patch_shape = self.pars['patch_shape'][:2] + \
                       (m*self.pars['patch_shape'][2],)
 
+        # keeping the volumes inside the graph,
+        # if the model should be index-fed
+        if 'index_fed' in self.pars and \
+           self.pars['index_fed']:
+            input_volumes = NN.IndexFedInput(
+                [padded_imgs],
+                self.pars['patch_shape'],
+                [self.pars['stats']])
+        else:
+            input_volumes = None
+
         model = NN.create_model(
             self.pars['model_name'],
             self.pars['dropout_rate'], 
@@ -358,7 +366,16 @@ class Experiment(object):
             self.pars['grad_layers'],
             self.pars['train_layers'],
             self.pars['optimizer_name'],
-            patch_shape)
+            patch_shape,
+            input_volumes)
+        # running all MC-dropout passes at once
+        if 'MC_head' in self.pars and self.pars['MC_head']:
+            NN.add_MC_head(model, self.pars['MC_iters'])
+        # per-sample gradients of a batch of candidates
+        # (the graph will be finalized before querying)
+        if method_name=='fi':
+            model.get_batch_gradients(model.grad_layers,
+                                      shrink_method='sum')
         
         # printing the accuracies so far:
         curr_fmeas = np.loadtxt(os.path.join(
@@ -374,6 +391,8 @@ class Experiment(object):
             model.initialize_graph(sess)
             model.load_weights(os.path.join(
                 method_path,'curr_weights.h5'), sess)
+            if input_volumes:
+                input_volumes.load(sess)
             sess.graph.finalize()
 
             # starting the iterations
@@ -443,7 +462,8 @@ class Experiment(object):
                     self.pars['patch_shape'],
                     self.pars['ntb'],
                     self.pars['stats'],
-                    'prediction')[0]
+                    'prediction',
+                    vol_ind=0 if input_volumes else None)[0]
 
                 # saving the predictions
                 curr_predicts = np.loadtxt(
@@ -694,17 +714,25 @@ class Experiment_MultiImg(Experiment):
         
         """ Pool/Training Indices """
         # first load up all the indices for
-        # pool images
-        if 'pool_paths' in self.pars:
+        # pool images (or the saved pool of a
+        # previous run of this method)
+        pool_path = os.path.join(method_path,
+                                 'pool_index.npz')
+        pool_loaded = os.path.exists(pool_path)
+        if pool_loaded:
+            pool_inds = patch_utils.PoolIndex.load(pool_path)
+        elif 'pool_paths' in self.pars:
             pool_inds = [[] for i in 
                          range(len(self.train_paths))]
             for i in self.pars['pool_paths']:
                 pinds,_ = gen_multimg_inds(
                     [self.train_paths[i]], self.pars['grid_spacing'])
                 pool_inds[i] = pinds[0]
+            pool_inds = patch_utils.PoolIndex(pool_inds)
         else:
             pool_inds,_ = gen_multimg_inds(
                 self.train_paths, self.pars['grid_spacing'])
+            pool_inds = patch_utils.PoolIndex(pool_inds)
 
         """ Training Indices """
         # initial indices, if any
@@ -731,7 +759,11 @@ class Experiment_MultiImg(Experiment):
             for ind in np.unique(Qs[:,1]):
                 I = Qs[Qs[:,1]==ind,0]
                 training_inds[ind] += I.tolist()
-                [pool_inds[ind].remove(i) for i in I]
+                # a saved pool might miss the last queries
+                # (if the run stopped right after saving
+                # them), hence it is reconciled with them
+                pool_inds.remove_voxels(ind, I, 
+                                        strict=not(pool_loaded))
         
 
         """ Load and Pad Training Images """
@@ -740,25 +772,51 @@ class Experiment_MultiImg(Experiment):
             rads[i] = int(
                 (self.pars['patch_shape'][i]-1)/2.)
 
+        if 'volume_cache_bytes' in self.pars:
+            patch_utils.volume_cache.set_budget(
+                self.pars['volume_cache_bytes'])
         all_padded_imgs = []
         m = len(self.train_paths[0])-1
-        for sub_paths in self.train_paths:
-            padded_imgs = []
-            for i,path in enumerate(sub_paths):
-                img,_ = nrrd.read(path)
-                # if mask, don't pad it
-                if i==m:
-                    padded_imgs += [img]
-                    continue
-                padded_img = np.pad(
-                    img,
-                    ((rads[0],rads[0]),
-                     (rads[1],rads[1]),
-                     (rads[2],rads[2])),
-                    'constant')
-                padded_imgs += [padded_img]
-
-            all_padded_imgs += [padded_imgs]
+        if 'mmap_volumes' in self.pars and \
+           self.pars['mmap_volumes']:
+            # memory-mapped volumes, shared between
+            # processes running on the same experiment
+            store_dir = os.path.join(self.root_dir,
+                                     'padded_volumes')
+            if not(os.path.exists(os.path.join(
+                    store_dir, 'store_info.txt'))):
+                write_padded_store(self, store_dir)
+            all_padded_imgs = load_padded_store(
+                self, store_dir)
+        else:
+            for sub_paths in self.train_paths:
+                padded_imgs = []
+                for i,path in enumerate(sub_paths):
+                    # if mask, don't pad it
+                    if i==m:
+                        padded_imgs += [patch_utils.\
+                                        load_padded_volume(path)]
+                        continue
+                    padded_imgs += [patch_utils.\
+                                    load_padded_volume(path, rads)]
+
+                all_padded_imgs += [padded_imgs]
+
+        # pre-extracted patches of the whole grid of
+        # the pool, written once for the experiment
+        if 'patch_bank' in self.pars and \
+           self.pars['patch_bank']:
+            bank_dir = os.path.join(self.root_dir,
+                                    'patch_bank')
+            if not(os.path.exists(os.path.join(
+                    bank_dir, 'bank_info.txt'))):
+                dtype = self.pars['patch_bank'] if \
+                        isinstance(self.pars['patch_bank'], str) \
+                        else 'float32'
+                write_patch_bank(self, all_padded_imgs,
+                                 pool_inds.grids, bank_dir,
+                                 dtype)
+            self.patch_banks = load_patch_banks(self, bank_dir)
 
         """ Loading the Model """
         tf.reset_default_graph()
@@ -766,6 +824,15 @@ class Experiment_MultiImg(Experiment):
         m = len(self.train_paths[0])-1
         patch_shape = self.pars['patch_shape'][:2] + \
                       (m*self.pars['patch_shape'][2],)
+        if 'index_fed' in self.pars and \
+           self.pars['index_fed']:
+            input_volumes = NN.IndexFedInput(
+                [imgs[:m] for imgs in all_padded_imgs],
+                self.pars['patch_shape'],
+                [[self.train_stats[i,2*j:2*j+2] for j in range(m)]
+                 for i in range(len(all_padded_imgs))])
+        else:
+            input_volumes = None
         model = NN.create_model(
             self.pars['model_name'],
             self.pars['dropout_rate'], 
@@ -774,10 +841,24 @@ class Experiment_MultiImg(Experiment):
             self.pars['grad_layers'],
             self.pars['train_layers'],
             self.pars['optimizer_name'],
-            patch_shape)
+            patch_shape,
+            input_volumes)
         model.add_assign_ops()
-
-        if method_name=='ensemble':
+        # running all MC-dropout passes at once
+        if 'MC_head' in self.pars and self.pars['MC_head']:
+            NN.add_MC_head(model, self.pars['MC_iters'])
+        # per-sample gradients of a batch of candidates
+        # (the graph will be finalized before querying)
+        if method_name=='fi':
+            model.get_batch_gradients(model.grad_layers,
+                                      shrink_method='sum')
+
+        if method_name in ['ensemble', 'QBC-JS']:
+            # number of members of the ensemble
+            if 'ensemble_size' in self.pars:
+                n_members = self.pars['ensemble_size']
+            else:
+                n_members = 7
             self.model_holder = NN.create_model(
                         self.pars['model_name'],
                         self.pars['dropout_rate'], 
@@ -788,11 +869,18 @@ class Experiment_MultiImg(Experiment):
                         self.pars['optimizer_name'],
                         patch_shape)
             self.model_holder.add_assign_ops()
+            # all the members evaluated at once
+            if 'stacked_ensemble' in self.pars and \
+               self.pars['stacked_ensemble']:
+                self.ensemble = NN_extended.ModelEnsemble(
+                    self.model_holder, n_members)
 
 
         with tf.Session() as sess:
             # doing a first global initialization 
             sess.run(tf.global_variables_initializer())
+            if input_volumes:
+                input_volumes.load(sess)
             sess.graph.finalize()
             model.perform_assign_ops(
                 self.pars['init_weights_path'], sess)
@@ -821,7 +909,8 @@ class Experiment_MultiImg(Experiment):
                     labeled_inds = training_inds
                     self.labeled_stats = self.train_stats
 
-                if method_name=='ensemble' and n_labels==0:
+                if method_name in ['ensemble', 'QBC-JS'] and \
+                   n_labels==0:
                     # paths to ensemble of pre-trained models
                     base_path = '/fileserver/external/rawabd/'+\
                                 'Jamshid/PWNNAL_results/'+\
@@ -829,9 +918,10 @@ class Experiment_MultiImg(Experiment):
                     self.pretrained_paths = [
                         self.pars['init_weights_path']] + \
                         [os.path.join(base_path,'%s/model_pars.h5'%i)
-                         for i in range(1,7)]
+                         for i in range(1,n_members)]
 
-                elif method_name=='ensemble' and n_labels>0:
+                elif method_name in ['ensemble', 'QBC-JS'] and \
+                     n_labels>0:
                     # load the model_holder by the weights
                     # of the previous model 
                     # current iter: t
@@ -870,19 +960,22 @@ class Experiment_MultiImg(Experiment):
                 for ind in range(len(Q_inds)):
                     if len(Q_inds[ind]>0):
                         Q_mat[cnt:cnt+len(Q_inds[ind]),
-                              0] = np.array(pool_inds[ind])[Q_inds[ind]]
+                              0] = pool_inds[ind][Q_inds[ind]]
                         Q_mat[cnt:cnt+len(Q_inds[ind]),
                               1] = ind
                         cnt += len(Q_inds[ind])
                         # adding to the training
-                        training_inds[ind] += list(np.array(
-                            pool_inds[ind])[Q_inds[ind]])
+                        training_inds[ind] += list(
+                            pool_inds[ind][Q_inds[ind]])
                         # remove from the pool
-                        sorted_inds = -np.sort(-Q_inds[ind])
-                        [pool_inds[ind].pop(i) for i in sorted_inds]
+                        pool_inds.remove(ind, Q_inds[ind])
                         
                 np.savetxt(q_file, Q_mat, fmt='%d')
+                pool_inds.save(pool_path)
                 np.savetxt(t_file, [dt])
+                if hasattr(self, 'patch_banks'):
+                    for bank in self.patch_banks:
+                        bank.report()
                 iters += 1
 
                 """ Finetuning the Model """
@@ -975,6 +1068,212 @@ def gen_multimg_inds(dat_paths, grid_spacing):
     return all_inds, all_labels
         
 
+def write_padded_store(expr, store_dir=None):
+    """Writing padded volumes of all training subjects
+    of a multi-image experiment into `.npy` files, to
+    be memory-mapped later by `load_padded_store`
+
+    The volumes are kept in their native data type,
+    the modalities are zero-padded with the patch 
+    radii and the mask (last element of each subject's
+    paths) is stored without padding. The files will 
+    be named `<subject>_<modality>.npy` (indices into
+    `expr.train_paths`) and placed in `store_dir`
+    (default: `padded_volumes` in the root of the
+    experiment) together with `store_info.txt` that
+    records the paths and radii. Existing files are
+    re-used only if the recorded paths and radii match
+    those of the experiment, otherwise the whole store
+    is written again.
+    """
+
+    if store_dir is None:
+        store_dir = os.path.join(expr.root_dir,
+                                 'padded_volumes')
+    if not(os.path.exists(store_dir)):
+        os.mkdir(store_dir)
+
+    rads = np.zeros(3, dtype=int)
+    for i in range(3):
+        rads[i] = int(
+            (expr.pars['patch_shape'][i]-1)/2.)
+
+    # files of a store written for other paths or radii
+    # cannot be told apart from the valid ones by their
+    # names, hence they are all removed
+    info_path = os.path.join(store_dir, 'store_info.txt')
+    info = {'paths': expr.train_paths,
+            'rads': rads.tolist()}
+    reuse = False
+    if os.path.exists(info_path):
+        with open(info_path, 'r') as f:
+            old_info = yaml.load(f)
+        reuse = old_info==info
+    if not(reuse):
+        for fname in os.listdir(store_dir):
+            if fname.endswith('.npy') or \
+               fname.endswith('.npy.tmp'):
+                os.remove(os.path.join(store_dir, fname))
+        # recording the info before the volumes, so that
+        # an interrupted run can re-use what is written
+        with open(info_path+'.tmp', 'w') as f:
+            yaml.dump(info, f)
+        os.rename(info_path+'.tmp', info_path)
+
+    m = len(expr.train_paths[0])-1
+    for i, sub_paths in enumerate(expr.train_paths):
+        for j, path in enumerate(sub_paths):
+            npy_path = os.path.join(store_dir,
+                                    '%d_%d.npy'% (i,j))
+            if os.path.exists(npy_path):
+                continue
+            img,_ = nrrd.read(path)
+            # mask is not padded
+            r = np.zeros(3, dtype=int) if j==m else rads
+            pad_shape = tuple(
+                int(img.shape[k]+2*r[k]) for k in range(3))
+            # padding directly into the file, hence
+            # no padded copy is made in memory
+            vol = np.lib.format.open_memmap(
+                npy_path+'.tmp', mode='w+',
+                dtype=img.dtype, shape=pad_shape)
+            vol[...] = 0
+            vol[r[0]:r[0]+img.shape[0],
+                r[1]:r[1]+img.shape[1],
+                r[2]:r[2]+img.shape[2]] = img
+            vol.flush()
+            del vol
+            # renaming at the end so that a half-written
+            # volume is never taken as a complete one
+            os.rename(npy_path+'.tmp', npy_path)
+
+    return store_dir
+
+
+def load_padded_store(expr, store_dir=None):
+    """Loading padded volumes written by
+    `write_padded_store` as read-only memory-maps
+    
+    The output has the same structure as
+    `all_padded_imgs` in `Experiment_MultiImg.run_method`
+    (padded modalities of each subject followed by its
+    mask), but the pages of the volumes are read 
+    from the disk on demand and shared between all
+    processes that map the same files.
+    """
+
+    if store_dir is None:
+        store_dir = os.path.join(expr.root_dir,
+                                 'padded_volumes')
+
+    rads = [int((expr.pars['patch_shape'][i]-1)/2.)
+            for i in range(3)]
+    with open(os.path.join(store_dir,
+                           'store_info.txt'), 'r') as f:
+        info = yaml.load(f)
+    if info['paths']!=expr.train_paths or \
+       info['rads']!=rads:
+        raise ValueError(
+            "The padded volume store in %s "% store_dir +
+            "does not match paths or patch shape "+
+            "of the experiment.")
+
+    all_padded_imgs = []
+    for i, sub_paths in enumerate(expr.train_paths):
+        all_padded_imgs += [[np.load(
+            os.path.join(store_dir, '%d_%d.npy'% (i,j)),
+            mmap_mode='r') for j in range(len(sub_paths))]]
+
+    return all_padded_imgs
+
+
+def write_patch_bank(expr, all_padded_imgs, pool_inds,
+                     bank_dir=None, dtype='float32',
+                     chunk_size=5000):
+    """Writing normalized patches of the pool of all
+    training subjects of a multi-image experiment into
+    memory-mapped files, to be loaded later by
+    `load_patch_banks` (see `patch_utils.PatchBank`)
+
+    The patches of the i-th subject are written for all
+    the voxels of `pool_inds[i]` in `<i>_patches.npy` 
+    (and the voxel indices in `<i>_inds.npy`) inside 
+    `bank_dir` (default: `patch_bank` in the root of the
+    experiment). The intensities are normalized by the
+    statistics of the training images and stored with the
+    given `dtype` (`float16` halves the disk footprint).
+    """
+
+    if bank_dir is None:
+        bank_dir = os.path.join(expr.root_dir,
+                                'patch_bank')
+    if not(os.path.exists(bank_dir)):
+        os.mkdir(bank_dir)
+
+    patch_shape = expr.pars['patch_shape']
+    d1,d2,d3 = patch_shape
+    m = len(all_padded_imgs[0])-1
+    for i in range(len(pool_inds)):
+        inds = np.array(pool_inds[i], dtype=int)
+        npy_path = os.path.join(bank_dir, '%d_patches.npy'% i)
+        if os.path.exists(npy_path):
+            continue
+
+        patches = np.lib.format.open_memmap(
+            npy_path+'.tmp', mode='w+', dtype=dtype,
+            shape=(len(inds),d1,d2,int(m*d3)))
+        for t in range(0, len(inds), chunk_size):
+            chunk = patch_utils.get_patches(
+                all_padded_imgs[i][:m], 
+                inds[t:t+chunk_size],
+                patch_shape)
+            for j in range(m):
+                chunk[:,:,:,j*d3:(j+1)*d3] = (
+                    chunk[:,:,:,j*d3:(j+1)*d3] -
+                    expr.train_stats[i,2*j]
+                )/expr.train_stats[i,2*j+1]
+            patches[t:t+chunk_size] = chunk
+        patches.flush()
+        del patches
+        np.save(os.path.join(bank_dir, '%d_inds.npy'% i), inds)
+        # renaming at the end so that a half-written
+        # bank is never taken as a complete one
+        os.rename(npy_path+'.tmp', npy_path)
+
+    with open(os.path.join(bank_dir,
+                           'bank_info.txt'), 'w') as f:
+        yaml.dump({'paths': expr.train_paths,
+                   'patch_shape': list(patch_shape),
+                   'dtype': str(dtype)}, f)
+
+    return bank_dir
+
+
+def load_patch_banks(expr, bank_dir=None):
+    """Loading the patch banks written by 
+    `write_patch_bank`, one for each training
+    subject
+    """
+
+    if bank_dir is None:
+        bank_dir = os.path.join(expr.root_dir,
+                                'patch_bank')
+    with open(os.path.join(bank_dir,
+                           'bank_info.txt'), 'r') as f:
+        info = yaml.load(f)
+    if info['paths']!=expr.train_paths or \
+       info['patch_shape']!=list(expr.pars['patch_shape']):
+        raise ValueError(
+            "The patch bank in %s "% bank_dir +
+            "does not match paths or patch shape "+
+            "of the experiment.")
+
+    return [patch_utils.PatchBank(
+        os.path.join(bank_dir, '%d_inds.npy'% i),
+        os.path.join(bank_dir, '%d_patches.npy'% i))
+            for i in range(len(expr.train_paths))]
+
+
 def prep_AL_data(expr, flag=''):
     """Preparing the target data set, including
     unlabeled pool and test samples for running
@@ -1052,13 +1351,18 @@ def finetune(model,
     b = expr.pars['b']
     patch_shape = expr.pars['patch_shape']
     stats = expr.pars['stats']
-
-    for t in range(expr.pars['epochs']):
-        # batch-ify the data
-        batch_inds = NN.gen_batch_inds(n, b)
-
-        for i in range(len(batch_inds)):
-            img_inds = train_inds[batch_inds[i]]
+    input_volumes = getattr(model, 'input_volumes', None)
+
+    def make_batch(batch_inds):
+        img_inds = train_inds[batch_inds]
+        if input_volumes:
+            # patches are gathered in the graph,
+            # only the labels are needed here
+            labels = mask[np.unravel_index(
+                img_inds, mask.shape)]
+            feed_dict = input_volumes.get_feed_dict(
+                np.zeros(len(img_inds)), img_inds)
+        else:
             patches, labels = patch_utils.\
                               get_patches(
                                   padded_imgs,
@@ -1066,26 +1370,36 @@ def finetune(model,
                                   patch_shape,
                                   True,
                                   mask)
-            # hot-one vector for labels
-            hot_labels = np.zeros(
-                (2, len(labels)))
-            hot_labels[0,labels==0]=1
-            hot_labels[1,labels==1]=1
-
             # normalizing the patches
             for j in range(m):
                 patches[:,:,:,j] = (
                     patches[:,:,:,j]-stats[
                         j][0])/stats[j][1] 
-
-            # perform this iteration
-            # batch gradient step
-            sess.run(
-                model.train_step,
-                feed_dict={
-                    model.x: patches,
-                    model.y_: hot_labels,
-                    model.keep_prob:model.dropout_rate})
+            feed_dict = {model.x: patches}
+
+        # hot-one vector for labels
+        hot_labels = np.zeros(
+            (2, len(labels)))
+        hot_labels[0,labels==0]=1
+        hot_labels[1,labels==1]=1
+        feed_dict.update({model.y_: hot_labels})
+
+        return feed_dict
+
+    # batches are prepared in the background
+    # while the training steps are running
+    depth = expr.pars['prefetch_depth'] if \
+            'prefetch_depth' in expr.pars else 2
+    batches = patch_utils.BatchPrefetcher(
+        make_batch, n, b, expr.pars['epochs'], depth)
+    for t, i, feed_dict in batches:
+        # perform this iteration
+        # batch gradient step
+        feed_dict.update({
+            model.keep_prob:model.dropout_rate})
+        sess.run(
+            model.train_step,
+            feed_dict=feed_dict)
 
 
 def finetune_multimg(expr,
@@ -1098,29 +1412,39 @@ def finetune_multimg(expr,
     img_ind_sizes = [len(training_inds[i]) for i 
                      in range(s)] 
     n = np.sum(img_ind_sizes)
+    index_map = patch_utils.GlobalIndexMap(img_ind_sizes)
     m = len(all_padded_imgs[0]) - 1
     b = expr.pars['b']
     d3 = expr.pars['patch_shape'][2]
-
-    for t in range(expr.pars['epochs']):
-        batch_inds = NN.gen_batch_inds(n, b)
-
-        for i in range(len(batch_inds)):
-            """ Preparing the Patches/Labels """
-
-            # batch indices are global indices,
-            # extract local indices for each image
-            local_inds = patch_utils.global2local_inds(
-                batch_inds[i], img_ind_sizes)
-            # local indices --> image (voxel) indices
-            img_inds = [np.array(training_inds[j])[
-                local_inds[j]] for j in range(s)]
-
+    input_volumes = getattr(model, 'input_volumes', None)
+
+    def make_batch(batch_inds):
+        """ Preparing the Patches/Labels """
+
+        # batch indices are global indices,
+        # extract local indices for each image
+        local_inds = index_map.split_list(batch_inds)
+        # local indices --> image (voxel) indices
+        img_inds = [np.array(training_inds[j])[
+            local_inds[j]] for j in range(s)]
+
+        if input_volumes:
+            # patches are gathered in the graph,
+            # only the labels are needed here
+            b_labels = np.concatenate([
+                all_padded_imgs[j][m][np.unravel_index(
+                    img_inds[j], all_padded_imgs[j][m].shape)]
+                for j in range(s)])
+            feed_dict = input_volumes.get_feed_dict(
+                np.concatenate([j*np.ones(len(img_inds[j]))
+                                for j in range(s)]),
+                np.concatenate(img_inds))
+        else:
             b_patches, b_labels = patch_utils.get_patches_multimg(
                 all_padded_imgs, img_inds,
                 expr.pars['patch_shape'], 
                 expr.train_stats)
-            
+
             # stitching patches and labels
             b_patches = [b_patches[j] for j in range(len(img_inds))
                          if len(img_inds[j])>0]
@@ -1129,23 +1453,31 @@ def finetune_multimg(expr,
             b_labels = [b_labels[j] for j in range(len(img_inds))
                         if len(img_inds[j])>0]
             b_labels = np.concatenate(b_labels)
-
-
-            # converting to hot-one vectors
-            hot_labels = np.zeros((2,len(b_labels)))
-            hot_labels[0,b_labels==0] = 1
-            hot_labels[1,b_labels==1] = 1
-
-            """ Doing an Optimization Iteration """
-            # finally we are ready to take 
-            # optimization step
-            sess.run(
-                model.train_step,
-                feed_dict={
-                    model.x: b_patches,
-                    model.y_: hot_labels,
-                    model.keep_prob:model.dropout_rate})
-
+            feed_dict = {model.x: b_patches}
+
+        # converting to hot-one vectors
+        hot_labels = np.zeros((2,len(b_labels)))
+        hot_labels[0,b_labels==0] = 1
+        hot_labels[1,b_labels==1] = 1
+        feed_dict.update({model.y_: hot_labels})
+
+        return feed_dict
+
+    # batches are prepared in the background
+    # while the training steps are running
+    depth = expr.pars['prefetch_depth'] if \
+            'prefetch_depth' in expr.pars else 2
+    batches = patch_utils.BatchPrefetcher(
+        make_batch, n, b, expr.pars['epochs'], depth)
+    for t, i, feed_dict in batches:
+        """ Doing an Optimization Iteration """
+        # finally we are ready to take 
+        # optimization step
+        feed_dict.update({
+            model.keep_prob:model.dropout_rate})
+        sess.run(
+            model.train_step,
+            feed_dict=feed_dict)
 
 
 def read_ints(file_path):
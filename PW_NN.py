@@ -31,15 +31,18 @@ def PW_train_epoch(model,
     trbatches = patch_utils.get_batches(
         trinds_dict,batch_size)
 
+    # the loader keeps the images in memory
+    # during the whole epoch
+    loader = patch_utils.DictBatchLoader(
+        trinds_dict,
+        trmask_dict,
+        patch_shape)
+
     mu = stats[0]
     sigma = stats[1]
     for batch in trbatches:
         (batch_tensors,
-         batch_labels) = patch_utils.get_batch_vars(
-             trinds_dict,
-             trmask_dict,
-             batch,
-             patch_shape)
+         batch_labels) = loader.get_batch(batch)
 
         batch_tensors = (
             batch_tensors-mu)/sigma
@@ -87,7 +90,8 @@ def PW_train_epoch_MultiModal(
         save_dir=[],
         costs=[1.,1.],
         ts_data=None,
-        tb_dir=None):
+        tb_dir=None,
+        prefetch_depth=2):
     """This function is similar to 
     `PW_train_epoch` except that it works
     with more than one modality; here 
@@ -107,6 +111,11 @@ def PW_train_epoch_MultiModal(
 
     Here the assumtion is that all
     modalities have the same shape.
+
+    The batches are prepared in a background
+    thread (see `patch_utils.BatchPrefetcher`),
+    with at most `prefetch_depth` of them 
+    waiting in the queue.
     """
 
     # number of all training samples
@@ -138,99 +147,99 @@ def PW_train_epoch_MultiModal(
     for i in range(s):
         sub_imgs = []
         for j in range(m):
-            img,_ = nrrd.read(tr_data[i][j])
-            padded_img = np.pad(
-                img, 
-                ((rads[0],rads[0]),
-                 (rads[1],rads[1]),
-                 (rads[2],rads[2])),
-                'constant')
-            sub_imgs += [padded_img]
+            sub_imgs += [patch_utils.load_padded_volume(
+                tr_data[i][j], rads)]
         padded_imgs += [sub_imgs]
         # adding mask
-        mask,_ = nrrd.read(tr_data[i][m])
-        masks += [mask]
+        masks += [patch_utils.load_padded_volume(
+            tr_data[i][m])]
 
 
+    """ Preparing the Batches """
+    index_map = patch_utils.GlobalIndexMap(
+        [len(tr_data[t][-1]) for t in range(s)])
+    def make_batch(batch_inds):
+        # extract indices of each image in this
+        # batch
+        local_inds = index_map.split_list(batch_inds)
+
+        # load patches image-by-image
+        bb = len(batch_inds)
+        b_patches = np.zeros((bb,
+                              patch_shape[0],
+                              patch_shape[1],
+                              m*patch_shape[2]))
+        b_labels = np.zeros(bb)
+        cnt = 0
+        for j in range(s):
+            if len(local_inds[j])>0:
+                img_inds = np.array(tr_data[j][-1])[
+                    local_inds[j]]
+                patches, labels = patch_utils.\
+                                  get_patches(
+                                      padded_imgs[j],
+                                      img_inds,
+                                      patch_shape,
+                                      True,
+                                      masks[j])
+                # normalizing the patches
+                for jj in range(m):
+                    patches[:,:,:,jj*d3:(jj+1)*d3] = (
+                        patches[:,:,:,jj*d3:(jj+1)*d3]-stats[
+                            j,2*jj])/stats[j,2*jj+1]
+
+                b_patches[cnt:cnt+len(img_inds),
+                          :,:,:] = patches
+                b_labels[
+                    cnt:cnt+len(img_inds)] = labels
+                cnt += len(img_inds)
+
+        # hot-one vector for labels
+        hot_b_labels = np.zeros((2, len(b_labels)))
+        hot_b_labels[0,b_labels==0]=1*costs[0]
+        hot_b_labels[1,b_labels==1]=1*costs[1]
+
+        return b_patches, hot_b_labels
+
     """ Starting the Training Epochs """
+    # batch-ify the data, the batches are 
+    # prepared in the background while the
+    # training steps are running
+    nbatches = int(np.ceil(n/float(b)))
+    batches = patch_utils.BatchPrefetcher(
+        make_batch, n, b, epochs, prefetch_depth)
     tb_cnt = 0
-    for t in range(epochs):
-        """ Preparing the Batches """
-        # batch-ify the data
-        batch_inds = NN.gen_batch_inds(n, b)
+    for t, i, (b_patches, hot_b_labels) in batches:
 
-        for i in range(len(batch_inds)):
-            
-            # extract indices of each image in this
-            # batch
-            local_inds = patch_utils.global2local_inds(
-                batch_inds[i], 
-                [len(tr_data[t][-1]) for t in range(s)])
-
-            # load patches image-by-image
-            b = len(batch_inds[i])
-            b_patches = np.zeros((b,
-                                  patch_shape[0],
-                                  patch_shape[1],
-                                  m*patch_shape[2]))
-            b_labels = np.zeros(b)
-            cnt = 0
-            for j in range(s):
-                if len(local_inds[j])>0:
-                    img_inds = np.array(tr_data[j][-1])[
-                        local_inds[j]]
-                    patches, labels = patch_utils.\
-                                      get_patches(
-                                          padded_imgs[j],
-                                          img_inds,
-                                          patch_shape,
-                                          True,
-                                          masks[j])
-                    # normalizing the patches
-                    for jj in range(m):
-                        patches[:,:,:,jj*d3:(jj+1)*d3] = (
-                            patches[:,:,:,jj*d3:(jj+1)*d3]-stats[
-                                j,2*jj])/stats[j,2*jj+1]
-
-                    b_patches[cnt:cnt+len(img_inds),
-                              :,:,:] = patches
-                    b_labels[
-                        cnt:cnt+len(img_inds)] = labels
-                    cnt += len(img_inds)
-                    
-            # hot-one vector for labels
-            hot_b_labels = np.zeros((2, len(b_labels)))
-            hot_b_labels[0,b_labels==0]=1*costs[0]
-            hot_b_labels[1,b_labels==1]=1*costs[1]
-
-            # finally the data is ready to
-            # perform this iteration
-            # batch gradient step
-            sess.run(
-                model.train_step,
-                feed_dict={
-                    model.x: b_patches,
-                    model.y_: hot_b_labels,
-                    model.keep_prob:model.dropout_rate})
-
-            # writing into TB every 100 iterations
-            if not(i%100):
-                if ts_data:
-                    eval_to_TB(
-                        model,
-                        sess,
-                        ts_data,
-                        padded_imgs,
-                        masks,
-                        stats,
-                        patch_shape,
-                        ntb,
-                        tb_writer,
-                        tb_cnt)
-
-                    tb_cnt += 1
-                    
-        if len(save_dir)>0:
+        # finally the data is ready to
+        # perform this iteration
+        # batch gradient step
+        sess.run(
+            model.train_step,
+            feed_dict={
+                model.x: b_patches,
+                model.y_: hot_b_labels,
+                model.keep_prob:model.dropout_rate})
+
+        # writing into TB every 100 iterations
+        if not(i%100):
+            if ts_data:
+                eval_to_TB(
+                    model,
+                    sess,
+                    ts_data,
+                    padded_imgs,
+                    masks,
+                    stats,
+                    patch_shape,
+                    ntb,
+                    tb_writer,
+                    tb_cnt)
+
+                tb_cnt += 1
+
+        # end of the epoch
+        if (i==nbatches-1) and len(save_dir)>0:
             model.save_weights(
                 os.path.join(save_dir,
                              'model_pars.h5'))
@@ -363,7 +372,12 @@ def batch_eval(model,
                stats,
                varnames,
                mask=None,
-               x_feed_dict={}):
+               x_feed_dict={},
+               vol_ind=None,
+               overlap=True,
+               patch_bank=None,
+               MC_iters=0,
+               selector=None):
     """evaluating a list of variables over
     a set of samples from different images
     in a batch-wise format
@@ -413,6 +427,59 @@ def batch_eval(model,
             array includes only the 
             probability of being masked
             (in a binary segmentation).
+
+            For an ensemble model (see
+            `NN_extended.ModelEnsemble`), the
+            variable `member_posteriors` gives 
+            these probabilities for all the 
+            members in an array with one row
+            per member.
+
+        **vol_ind** : integer (default: None)
+            if the model is index-fed (see
+            `NN.IndexFedInput`), index of the 
+            given image among the volumes kept
+            in the graph; the patches will then
+            be gathered in the graph
+
+        **overlap** : boolean (default: True)
+            if True, the next batch of patches 
+            is prepared in a worker thread while
+            the current one is being evaluated;
+            set it to False for debugging
+
+        **patch_bank** : `patch_utils.PatchBank` (default: None)
+            if given, normalized patches of the 
+            voxels are read from the bank (`stats`
+            will not be used for them); only the
+            voxels missing in the bank are extracted
+            from the images
+
+        **MC_iters** : integer (default: 0)
+            if positive, Monte-Carlo mode: each
+            batch is loaded once and `MC_iters`
+            stochastic passes are run over it (the
+            keep-probability should be given in
+            `x_feed_dict`); the passes are folded
+            into running sums, and `varnames` can 
+            only include the following scores:
+
+            - `posteriors`: mean posterior
+            - `entropy`: entropy of the mean posterior
+            - `BALD`: entropy of the mean posterior 
+              minus the mean of the entropies
+            - `variance`: variance of the posteriors
+
+        **selector** : callable (default: None)
+            if given, values of the (single) 
+            variable in `varnames` are passed to
+            it batch by batch as `selector(vals,
+            batch_inds)`, where `batch_inds` are 
+            positions of the samples in `inds`,
+            instead of being stored; e.g. the 
+            `push` method of a 
+            `patch_utils.TopBSelector`. The output
+            will then be an empty list.
     """
     
     # number of modalities
@@ -430,115 +497,217 @@ def batch_eval(model,
     if isinstance(img_dat[0], np.ndarray):
         padded_imgs = img_dat
     else:
-        # loading + padding 
+        # loading + padding (through the
+        # process-wide volume cache)
         img_paths = img_dat
-        padded_imgs = []
-        for j in range(m):
-            img,_ = nrrd.read(img_paths[j])
-            padded_img = np.pad(
-                img, 
-                ((rads[0],rads[0]),
-                 (rads[1],rads[1]),
-                 (rads[2],rads[2])),
-                'constant')
-            padded_imgs += [padded_img]
-
-    # preparing batch indices
+        padded_imgs = [patch_utils.load_padded_volume(
+            img_paths[j], rads) for j in range(m)]
+
     n = len(inds)
-    batch_ends = np.arange(0,n,batch_size)
-    if not(batch_ends[-1]==n):
-        batch_ends = np.append(
-            batch_ends, n)
 
     """ Evaluating the List of Variables """
+    # all the variables are evaluated together,
+    # hence each batch is loaded only once
     vals_list = []
-    for j,var in enumerate(varnames):
-        # create the array for this image
-        # and this variable in the first
-        # iteration
-        if var=='feature_layer':
-            fdim = model.feature_layer.shape[0].value
-            vals = np.zeros((fdim,n))
-        else:
-            vals = np.zeros(n)
-
-        # evaluate variable for this batch
-        model_var = getattr(model, var)
-        if (var=='loss') or (var=='hess_vecp'):
-            labels_flag = True
-        else:
-            labels_flag = False
-
-
-        """evaluating variables with no need
-        to batch labels
-        """
-        # going through batches
-        for i in range(1,len(batch_ends)):
-            # getting the chunk of indices
-            batch_inds = np.arange(
-                batch_ends[i-1],batch_ends[i])
-            b = len(batch_inds)
-            # loading tensors
-            # (not to be confused with 
-            # patch_utils.get_batches())
+    if selector is not None:
+        # nothing is stored
+        if len(varnames)>1 or varnames[0] in [
+                'feature_layer','member_posteriors','hess_vecp']:
+            raise ValueError('Only a single variable with one ' +
+                             'value per sample can be passed to ' +
+                             'a selector.')
+    else:
+        for var in varnames:
+            # create the array for this 
+            # variable
+            if var=='feature_layer':
+                fdim = model.feature_layer.shape[0].value
+                vals_list += [np.zeros((fdim,n))]
+            elif var=='member_posteriors':
+                vals_list += [np.zeros((model.n_members,n))]
+            else:
+                vals_list += [np.zeros(n)]
+    if MC_iters>0:
+        for var in varnames:
+            if var not in ['posteriors','entropy','BALD','variance']:
+                raise ValueError('Variable %s cannot be '% var +
+                                 'evaluated in Monte-Carlo mode.')
+        model_vars = []
+    else:
+        model_vars = [getattr(model, var) for var in varnames]
+    labels_flag = ('loss' in varnames) or \
+                  ('hess_vecp' in varnames)
+
+    def make_batch(batch_inds):
+        b = len(batch_inds)
+        # loading tensors
+        # (not to be confused with 
+        # patch_utils.get_batches())
+        if vol_ind is not None:
+            # index-fed model: patches are
+            # gathered inside the graph
+            img_inds = np.array(inds)[batch_inds]
+            x_dict = model.input_volumes.get_feed_dict(
+                vol_ind*np.ones(b), img_inds)
             if labels_flag:
-                (batch_tensors, 
-                 batch_labels) = patch_utils.get_patches(
-                     padded_imgs, 
-                     np.array(inds)[batch_inds],
-                     patch_shape,
-                     True,
-                     mask)
-
+                batch_labels = mask[np.unravel_index(
+                    img_inds, mask.shape)]
                 hot_labels = np.zeros((2,b))
                 hot_labels[0,batch_labels==0]=1
                 hot_labels[1,batch_labels==1]=1
+        else:
+            img_inds = np.array(inds)[batch_inds]
+            if patch_bank is not None:
+                # already normalized patches
+                batch_tensors, found = patch_bank.get_patches(
+                    img_inds)
             else:
-                batch_tensors = patch_utils.get_patches(
+                batch_tensors = None
+                found = np.zeros(b, dtype=bool)
+            missing = np.where(~found)[0]
+            if len(missing)>0:
+                # extracting (only) the voxels that are
+                # not in the bank, normalized modality by
+                # modality as in `write_patch_bank`
+                patches = patch_utils.get_patches(
                     padded_imgs, 
-                    np.array(inds)[batch_inds],
+                    img_inds[missing],
                     patch_shape)
-
-            for j in range(m):
-                batch_tensors[:,:,:,j] = (
-                    batch_tensors[
-                        :,:,:,j]-stats[j][0])/stats[j][1]
+                d3 = patch_shape[2]
+                for j in range(m):
+                    patches[:,:,:,j*d3:(j+1)*d3] = (
+                        patches[:,:,:,j*d3:(j+1)*d3]-stats[
+                            j][0])/stats[j][1]
+                if batch_tensors is None:
+                    batch_tensors = patches
+                else:
+                    batch_tensors[missing] = patches
+            x_dict = {model.x:batch_tensors}
 
             if labels_flag:
-                feed_dict = {
-                    model.x:batch_tensors,
-                    model.y_:hot_labels,
-                    model.keep_prob: 1.}
+                batch_labels = mask[np.unravel_index(
+                    img_inds, mask.shape)]
+                hot_labels = np.zeros((2,b))
+                hot_labels[0,batch_labels==0]=1
+                hot_labels[1,batch_labels==1]=1
+
+        if labels_flag:
+            feed_dict = {
+                model.y_:hot_labels,
+                model.keep_prob: 1.}
+        else:
+            feed_dict = {model.keep_prob: 1.}
+        feed_dict.update(x_dict)
+
+        return batch_inds, feed_dict
+
+    # going through batches; the next batch is 
+    # prepared in the background while the
+    # current one is being evaluated
+    batches = patch_utils.BatchPrefetcher(
+        make_batch, n, batch_size, 1, 
+        1 if overlap else 0, shuffle=False)
+    for _, _, (batch_inds, feed_dict) in batches:
+
+        # if a keep-probability different than
+        # 1. is to be used (e.g. in MC-dropout)
+        # put it in x_feed_dict and it will 
+        # replace 1. in the feed_dict.
+        feed_dict.update(x_feed_dict)
+        if MC_iters>0:
+            batch_vals = MC_scores(
+                sess, model, feed_dict, 
+                MC_iters, varnames)
+            if selector is not None:
+                selector(batch_vals[0], batch_inds)
+                continue
+            for j in range(len(varnames)):
+                vals_list[j][batch_inds] = batch_vals[j]
+            continue
+
+        batch_vals = sess.run(
+            model_vars,
+            feed_dict=feed_dict)
+        if selector is not None:
+            if varnames[0]=='posteriors':
+                selector(batch_vals[0][1,:], batch_inds)
             else:
-                feed_dict = {model.x:batch_tensors,
-                             model.keep_prob: 1.}
-
-            # if a keep-probability different than
-            # 1. is to be used (e.g. in MC-dropout)
-            # put it in x_feed_dict and it will 
-            # replace 1. in the feed_dict.
-            feed_dict.update(x_feed_dict)
-            batch_vals = sess.run(
-                model_var,
-                feed_dict=feed_dict)
+                selector(batch_vals[0], batch_inds)
+            continue
 
+        for j,var in enumerate(varnames):
             if var=='posteriors':
                 # keeping only posterior probability
                 # of being maksed
-                vals[batch_inds] = batch_vals[1,:]
+                vals_list[j][batch_inds] = batch_vals[j][1,:]
             elif var=='feature_layer':
-                vals[:,batch_inds] = batch_vals
+                vals_list[j][:,batch_inds] = batch_vals[j]
+            elif var=='member_posteriors':
+                vals_list[j][:,batch_inds] = batch_vals[j][:,1,:]
             elif var=='hess_vecp':
-                vals = batch_vals
+                vals_list[j] = batch_vals[j]
             else:
-                vals[batch_inds] = batch_vals                
-
-        vals_list += [vals]
+                vals_list[j][batch_inds] = batch_vals[j]
             
     return vals_list
 
 
+def MC_scores(sess, model, feed_dict, T, varnames):
+    """Running `T` stochastic passes over a batch
+    and computing Monte-Carlo scores of its samples
+    (see `batch_eval`)
+
+    Only running sums of the posteriors (of being
+    masked), their squares and their entropies are
+    kept, hence the memory does not grow with `T`.
+
+    If the model has an MC head with `T` passes
+    (see `NN.add_MC_head`), all the passes are run
+    in a single evaluation.
+    """
+
+    if getattr(model, 'MC_T', None)==T:
+        MC_posts = sess.run(model.MC_posteriors,
+                            feed_dict=feed_dict)[1,:,:]
+        get_posts = lambda t: MC_posts[t,:]
+    else:
+        get_posts = lambda t: sess.run(
+            model.posteriors, feed_dict=feed_dict)[1,:]
+
+    sum_posts = 0
+    sum_sq_posts = 0
+    sum_ents = 0
+    for t in range(T):
+        posts = get_posts(t)
+        sum_posts = sum_posts + posts
+        sum_sq_posts = sum_sq_posts + posts**2
+        sum_ents = sum_ents + binary_entropy(posts)
+
+    av_posts = sum_posts / T
+    scores = {'posteriors': av_posts,
+              'variance': np.maximum(
+                  sum_sq_posts/T - av_posts**2, 0.)}
+    if ('entropy' in varnames) or ('BALD' in varnames):
+        scores['entropy'] = binary_entropy(av_posts)
+        scores['BALD'] = scores['entropy'] - sum_ents/T
+
+    return [scores[var] for var in varnames]
+
+
+def binary_entropy(posts):
+    """Entropy of binary posteriors, with zero 
+    probabilities replaced by a small number
+    """
+
+    posts = np.array(posts, dtype=float)
+    neg_posts = 1-posts
+    posts[posts==0] += 1e-6
+    neg_posts[neg_posts==0] += 1e-6
+
+    return -posts*np.log(posts) - \
+        neg_posts*np.log(neg_posts)
+
+
 def get_accuracy(preds, labels):
     
     n = len(preds)
@@ -4,6 +4,7 @@ import numpy as np
 import warnings
 #import nibabel
 import time
+import hashlib
 import nrrd
 import pdb
 import os
@@ -13,6 +14,7 @@ import PW_NN
 import PW_AL
 import NNAL_tools
 import patch_utils
+import sim_utils
 
 
 def CNN_query(expr,
@@ -67,20 +69,19 @@ def CNN_query(expr,
     if method_name=='MC-entropy':
         x_feed_dict = {model.keep_prob:
                        model.dropout_rate}
-        # iterative averaging over MC iterations
-        total_posts = 0
-        for i in range(expr.pars['MC_iters']):
-            posts = PW_NN.batch_eval(
-                model,
-                sess,
-                padded_imgs,
-                pool_inds,
-                expr.pars['patch_shape'],
-                expr.pars['ntb'],
-                expr.pars['stats'],
-                'posteriors',
-                x_feed_dict)[0]
-            total_posts = (posts+i*total_posts)/(i+1)
+        # averaging over MC iterations
+        total_posts = PW_NN.batch_eval(
+            model,
+            sess,
+            padded_imgs,
+            pool_inds,
+            expr.pars['patch_shape'],
+            expr.pars['ntb'],
+            expr.pars['stats'],
+            'posteriors',
+            None,
+            x_feed_dict,
+            MC_iters=expr.pars['MC_iters'])[0]
         
         # k most uncertain (binary classes)
         q = np.argsort(np.abs(total_posts-.5))[
@@ -166,6 +167,148 @@ def CNN_query(expr,
     return q
 
 
+class PoolEvaluation(object):
+    """Class of memoized evaluations of a model
+    over the pool of a multi-image experiment
+
+    The object should be created once per
+    querying iteration (i.e. for a fixed set of
+    weights and a fixed pool). Variables of the
+    model (e.g. `posteriors`, `feature_layer` or
+    `prediction`) are evaluated lazily, only for
+    those pool samples that have not been 
+    evaluated before, and all the variables 
+    missing for a set of samples are computed in
+    the same pass over their patches. Hence,
+    different stages of a querying strategy can
+    ask for the variables they need without
+    computing any of them twice.
+
+    Evaluations are deterministic (`keep_prob=1`);
+    MC-dropout and ensemble passes should call 
+    `PW_NN.batch_eval` directly.
+    """
+
+    def __init__(self, 
+                 expr,
+                 model,
+                 sess,
+                 all_padded_imgs,
+                 pool_inds):
+
+        self.expr = expr
+        self.model = model
+        self.sess = sess
+        self.all_padded_imgs = all_padded_imgs
+        self.pool_inds = pool_inds
+        self.m = len(all_padded_imgs[0]) - 1
+
+        s = len(pool_inds)
+        self.values = [{} for i in range(s)]
+        self.done = [{} for i in range(s)]
+
+    def get(self, i, varnames, local_inds=None):
+        """Values of some variables over (a subset
+        of) the pool samples of the i-th subject
+
+        The output is a list with one array for
+        each variable, in the same format as the
+        outputs of `PW_NN.batch_eval`.
+        """
+
+        if not(isinstance(varnames, list)):
+            varnames = [varnames]
+        n = len(self.pool_inds[i])
+        if local_inds is None:
+            local_inds = np.arange(n)
+        else:
+            local_inds = np.array(local_inds, dtype=int)
+
+        # which variables each sample misses
+        missing = np.zeros((len(varnames), n), dtype=bool)
+        for v, var in enumerate(varnames):
+            if var not in self.done[i]:
+                self.done[i][var] = np.zeros(n, dtype=bool)
+            missing[v,local_inds] = ~self.done[i][var][local_inds]
+
+        # samples that miss the same variables
+        # are evaluated together (patterns of the
+        # missing variables are coded as bits)
+        codes = np.dot(2**np.arange(len(varnames)), missing)
+        for code in np.unique(codes[codes>0]):
+            pattern = [varnames[v] for v in range(len(varnames))
+                       if (code>>v)&1]
+            self.evaluate(i, pattern, np.where(codes==code)[0])
+        # (empty pools still need output arrays)
+        for var in varnames:
+            if var not in self.values[i]:
+                self.evaluate(i, [var], np.array([], dtype=int))
+
+        return [self.values[i][var][...,local_inds] 
+                for var in varnames]
+
+    def evaluate(self, i, varnames, local_inds):
+        """Evaluating some variables over a subset
+        of the pool samples of the i-th subject, and
+        storing the results
+        """
+
+        n = len(self.pool_inds[i])
+        stats = [[self.expr.train_stats[i,2*j],
+                  self.expr.train_stats[i,2*j+1]]
+                 for j in range(self.m)]
+        vals = PW_NN.batch_eval(
+            self.model,
+            self.sess,
+            self.all_padded_imgs[i][:-1],
+            self.pool_inds[i][local_inds],
+            self.expr.pars['patch_shape'],
+            self.expr.pars['ntb'],
+            stats,
+            varnames,
+            vol_ind=get_vol_ind(self.model, i),
+            patch_bank=get_patch_bank(self.expr, i))
+
+        for var, val in zip(varnames, vals):
+            if var not in self.values[i]:
+                shape = val.shape[:-1] + (n,)
+                self.values[i][var] = np.zeros(shape)
+            self.values[i][var][...,local_inds] = val
+            self.done[i][var][local_inds] = True
+
+    def get_all(self, var):
+        """Values of a variable over the whole pool,
+        as a list with one array per subject
+        """
+        
+        return [self.get(i, var)[0] 
+                for i in range(len(self.pool_inds))]
+
+
+def get_patch_bank(expr, i):
+    """Patch bank of the i-th training subject of
+    an experiment, if it has any
+    """
+    
+    if hasattr(expr, 'patch_banks'):
+        return expr.patch_banks[i]
+    else:
+        return None
+
+
+def get_vol_ind(model, i):
+    """Index of the i-th training subject among the
+    volumes kept in the graph, if the model is 
+    index-fed (see `NN.IndexFedInput`), to be passed
+    to `PW_NN.batch_eval`
+    """
+
+    if getattr(model, 'input_volumes', None):
+        return i
+    else:
+        return None
+
+
 def query_multimg(expr,
                   model,
                   sess,
@@ -188,19 +331,20 @@ def query_multimg(expr,
 
     k = expr.pars['k']
     B = expr.pars['B']
-    img_ind_sizes = [len(pool_inds[i]) for 
-                     i in range(len(pool_inds))]
+    if not(isinstance(pool_inds, patch_utils.PoolIndex)):
+        pool_inds = patch_utils.PoolIndex(pool_inds)
+    img_ind_sizes = pool_inds.sizes()
     n = np.sum(img_ind_sizes)
     m = len(all_padded_imgs[0]) - 1
+    # evaluations of the current model over the
+    # pool, shared by all stages of the strategy
+    evals = PoolEvaluation(expr, model, sess, 
+                           all_padded_imgs, pool_inds)
     
     if method_name=='random':
-        inds_num = [len(pool_inds[i]) for
-                    i in range(len(pool_inds))]
-        npool = np.sum(inds_num)
-        inds = np.random.permutation(npool)[:k]
+        inds = np.random.permutation(n)[:k]
         
-        Q_inds = patch_utils.global2local_inds(
-            inds, inds_num)
+        Q_inds = pool_inds.global2local(inds)
 
     if method_name=='ps-random':
 
@@ -210,7 +354,8 @@ def query_multimg(expr,
         for i in range(len(all_padded_imgs)):
             valid_pool_inds += [get_HV_inds(
                 all_padded_imgs[i][0], expr.pars['patch_shape'],
-                thr, pool_inds[i])]
+                thr, pool_inds[i], 
+                get_var_map_multimg(expr, all_padded_imgs, i))]
 
         valid_inds_sizes = [len(valid_pool_inds[i]) for
                             i in range(len(valid_pool_inds))]
@@ -229,118 +374,76 @@ def query_multimg(expr,
             expr, model, sess, all_padded_imgs,
             pool_inds, k)[0]
 
-    if method_name=='MC-entropy':
-        
-        x_feed_dict = {model.keep_prob:
-                       model.dropout_rate}
-        av_posts = 0
-        for i in range(expr.pars['MC_iters']):
-            # the argument `k` won't be really used
-            # in this line
-            posts = bin_uncertainty_filter_multimg(
-                expr, model, sess, all_padded_imgs,
-                pool_inds, k, x_feed_dict)
-            av_posts = (posts+i*av_posts)/(i+1)
-
-        inds = np.argsort(np.abs(av_posts-.5))[:k]
-
-        Q_inds = patch_utils.global2local_inds(
-            inds, img_ind_sizes)
-
-    if method_name=='BALD':
+    if method_name in ['MC-entropy', 'BALD']:
+        # MC scores of all pool samples, computed
+        # by MC_iters passes over each batch
         x_feed_dict = {model.keep_prob:
                        model.dropout_rate}
-        av_posts = 0
-        av_ents  = 0
-        for i in range(expr.pars['MC_iters']):
-            # the argument `k` won't be really used
-            # in this line
-            posts = bin_uncertainty_filter_multimg(
-                expr, model, sess, all_padded_imgs,
-                pool_inds, k, x_feed_dict)
-            av_posts = (posts+i*av_posts)/(i+1)
-
-            neg_posts = 1-posts
-            posts[posts==0] += 1e-6
-            neg_posts[neg_posts==0] += 1e-6
-            ents = -posts*np.log(posts) -\
-                  neg_posts*np.log(neg_posts)
-            # average entropies
-            av_ents = (ents+i*av_ents)/(i+1)
-            
-        # entropy of average posteriors
-        av_neg_posts = 1-av_posts
-        av_posts[av_posts==0] += 1e-6
-        av_neg_posts[av_neg_posts==0] += 1e-6
-        ent_av_posts = -av_posts*np.log(av_posts)-\
-                       av_neg_posts*np.log(av_neg_posts)
-
-        scores = ent_av_posts - av_ents
-        inds = np.argsort(-scores)[:k]
-
-        Q_inds = patch_utils.global2local_inds(
-            inds, img_ind_sizes)
-
-    if method_name=='rep-entropy':
-
-        # extracting features
-        F = [[] for i in range(len(pool_inds))]
+        if method_name=='MC-entropy':
+            key = lambda p: np.abs(p-.5)
+        else:
+            key = np.negative
+        selector = patch_utils.TopBSelector(
+            k, len(pool_inds), key)
         for i in range(len(pool_inds)):
-            stats = []
-            for j in range(m):
-                stats += [[expr.train_stats[i,2*j],
-                           expr.train_stats[i,2*j+1]]]
-
-            F[i] = PW_NN.batch_eval(
-                model,sess,
+            if len(pool_inds[i])==0:
+                continue
+            stats = [[expr.train_stats[i,2*j],
+                      expr.train_stats[i,2*j+1]]
+                     for j in range(m)]
+            PW_NN.batch_eval(
+                model, sess,
                 all_padded_imgs[i][:-1],
                 pool_inds[i],
                 expr.pars['patch_shape'],
                 expr.pars['ntb'],
                 stats,
-                'feature_layer')[0]
+                'posteriors' if method_name=='MC-entropy' 
+                else 'BALD',
+                None,
+                x_feed_dict,
+                vol_ind=get_vol_ind(model, i),
+                patch_bank=get_patch_bank(expr, i),
+                MC_iters=expr.pars['MC_iters'],
+                selector=lambda v, b: selector.push(v, b, i))
+
+        Q_inds = selector.result()[0]
+
+    if method_name=='rep-entropy':
+
+        # extracting features and posteriors
+        # in one pass
+        F = [[] for i in range(len(pool_inds))]
+        posts = [[] for i in range(len(pool_inds))]
+        for i in range(len(pool_inds)):
+            F[i], posts[i] = evals.get(
+                i, ['feature_layer', 'posteriors'])
 
         # get the most uncertain samples
         sel_inds,sel_posts = bin_uncertainty_filter_multimg(
             expr, model, sess, all_padded_imgs,
-            pool_inds, B)
+            pool_inds, B, posts=posts)
 
-        F_uncertain = [F[i][:,sel_inds[i]] for i in
-                       range(len(sel_inds)) if 
-                       len(sel_inds[i])>0]
-        F_uncertain = np.concatenate(F_uncertain, axis=1)
+        X_uncertain = [sim_utils.normalize_features(
+            F[i][:,sel_inds[i]]) for i in range(len(sel_inds))
+                       if len(sel_inds[i])>0]
+        X_uncertain = np.concatenate(X_uncertain)
         for i in range(len(pool_inds)):
             rem_inds = list(set(np.arange(len(pool_inds[i]))) - 
                             set(sel_inds[i]))
-            F[i] = F[i][:, rem_inds]
-        F = np.concatenate(F, axis=1)
+            F[i] = sim_utils.normalize_features(F[i][:, rem_inds])
+        X_rem = np.concatenate(F)
+        del F
 
-        # norms
-        norms_rem = np.sqrt(np.sum(F**2, axis=0))
-        norms_uncertain = np.sqrt(np.sum(F_uncertain**2, 
-                                         axis=0))
         # compute cos-similarities between filtered images
         # and the rest of the unlabeled samples
-        dots = np.dot(F.T, F_uncertain)
-        norms_outer = np.outer(norms_rem, norms_uncertain)
-        sims = dots / norms_outer
-        del dots, norms_rem, norms_uncertain, norms_outer
-
-        # start from empty set
-        Q_inds = []
-        nQ_inds = np.arange(B)
+        sims = sim_utils.cosine_sims(X_rem, X_uncertain)
+        del X_rem, X_uncertain
+
         # add most representative samples one by one
-        for i in range(expr.pars['k']):
-            rep_scores = np.zeros(B-i)
-            for j in range(B-i):
-                cand_Q = Q_inds + [nQ_inds[j]]
-                rep_scores[j] = np.sum(
-                    np.max(sims[:, cand_Q], axis=1))
-            iter_sel = nQ_inds[np.argmax(rep_scores)]
-            # update the iterating sets
-            Q_inds += [iter_sel]
-            nQ_inds = np.delete(
-                nQ_inds, np.argmax(rep_scores))
+        lazy = 'lazy_rep' in expr.pars and expr.pars['lazy_rep']
+        Q_inds = NNAL_tools.FacilityLocation(sims).select(
+            expr.pars['k'], lazy)
         
         # transforming global Q_inds into local one
         img_ind_sizes = [len(sel_inds[i]) for i
@@ -351,198 +454,107 @@ def query_multimg(expr,
                   for i in range(len(sel_inds))]
 
     if method_name=='core-set':
-        # getting the feature matrices
-        # form full feature matrix of unlabeled pool
-        # because we need to have them in all iterations
-        F_u = [[] for i in range(len(pool_inds))]
+        # pre-normalized features of the whole pool
+        X = []
         for i in range(len(pool_inds)):
-            stats = []
-            for j in range(m):
-                stats += [[expr.train_stats[i,2*j],
-                           expr.train_stats[i,2*j+1]]]
-
-            F_u[i] = PW_NN.batch_eval(
-                model,sess,
+            if len(pool_inds[i])==0:
+                continue
+            stats = [[expr.train_stats[i,2*j],
+                      expr.train_stats[i,2*j+1]]
+                     for j in range(m)]
+            X += [sim_utils.normalize_features(PW_NN.batch_eval(
+                model, sess,
                 all_padded_imgs[i][:-1],
                 pool_inds[i],
                 expr.pars['patch_shape'],
                 expr.pars['ntb'],
                 stats,
-                'feature_layer')[0]
-
-        F_u = np.concatenate(F_u, axis=1)
-        n = F_u.shape[1]
-        norms_u = np.sqrt(np.sum(F_u**2, axis=0))
-        sims = -np.inf*np.ones(n)
-
-        nT = np.sum([len(labeled_inds[i]) for i 
-                     in range(len(labeled_inds))])
-        if True:
-
-            # for labeled data, do not need to keep
-            # the features in memory, since we only
-            # need to have the max-similarities
+                'feature_layer',
+                vol_ind=get_vol_ind(model, i),
+                patch_bank=get_patch_bank(expr, i))[0])]
+        n_threads = expr.pars['sim_threads'] if \
+                    'sim_threads' in expr.pars and \
+                    expr.pars['sim_threads'] else 1
+        k_center = NNAL_tools.KCenterGreedy(np.concatenate(X),
+                                            n_threads=n_threads)
+        del X
+
+        # distances to the labeled samples are cached
+        # for the current model, labeled set and pool
+        cache_path = core_set_cache_path(
+            expr, model, sess, pool_inds, labeled_inds)
+        if os.path.exists(cache_path):
+            k_center.min_dists = np.load(cache_path)
+        else:
             for i in range(len(labeled_inds)):
                 labeled_stats = []
                 for j in range(m):
                     labeled_stats += [
                         [expr.labeled_stats[i,2*j],
                          expr.labeled_stats[i,2*j+1]]]
-
-            # this extra-batching is because of
-            # memory issues;F_u and F_T are too
-            # large to keep in the memory at th
-            # same time
-            nT = len(labeled_inds[i])
-            batches = NN.gen_batch_inds(nT,1000)
-
-            for batch_inds in batches:
                 if expr.labeled_paths==expr.train_paths:
-                    F_T = PW_NN.batch_eval(
-                        model, sess,
-                        all_padded_imgs[i][:-1],
-                        np.array(labeled_inds[i])[batch_inds],
-                        expr.pars['patch_shape'],
-                        expr.pars['ntb'],
-                        labeled_stats,
-                        'feature_layer')[0]
+                    img_dat = all_padded_imgs[i][:-1]
+                    vol_ind = get_vol_ind(model, i)
                 else:
+                    img_dat = expr.labeled_paths[i][:-1]
+                    vol_ind = None
+
+                # labeled features are evaluated in
+                # batches, and only their distances
+                # to the pool are kept
+                nT = len(labeled_inds[i])
+                batches = NN.gen_batch_inds(nT,1000)
+                for batch_inds in batches:
                     F_T = PW_NN.batch_eval(
                         model, sess,
-                        expr.labeled_paths[i][:-1],
+                        img_dat,
                         np.array(labeled_inds[i])[batch_inds],
                         expr.pars['patch_shape'],
                         expr.pars['ntb'],
                         labeled_stats,
-                        'feature_layer')[0]
-                    
-                norms_T = np.sqrt(np.sum(F_T**2, axis=0))
-                # cosine similarities
-                dots = np.dot(F_T.T, F_u)
-                norms_outer = np.outer(norms_T, norms_u)
-                sims = np.max(np.concatenate((
-                    dots / norms_outer,
-                    np.expand_dims(sims, axis=0)), axis=0), 
-                              axis=0)
-
-                del dots, norms_T, norms_outer
-
-            if nT>2000:
-                np.savetxt(os.path.join(
-                    expr.root_dir,'core-set/UT_sims.txt'), sims)
-        else:
-            sims = np.loadtxt(os.path.join(
-                expr.root_dir,'core-set/UT_sims.txt'))
-
-        Q_inds = []
-        for t in range(k):
-            q_ind = np.argmin(sims)
-            Q_inds += [q_ind]
-            # computing the similarities between the 
-            # selected sample and rest of the pool
-            s_ind = np.dot(F_u[:,q_ind].T, F_u)/\
-                (norms_u*norms_u[q_ind])
-            sims = np.maximum(sims, s_ind)
-            # put inf in place of selected index as an 
-            # indicator that it should be ignored  
-            sims[q_ind] = np.inf
-
-        Q_inds = patch_utils.global2local_inds(
-            Q_inds, img_ind_sizes)
+                        'feature_layer',
+                        vol_ind=vol_ind)[0]
+                    k_center.add_centers(
+                        sim_utils.normalize_features(F_T))
+            save_core_set_cache(cache_path, k_center.min_dists)
+
+        Q_inds = k_center.select(k)
+        Q_inds = pool_inds.global2local(Q_inds)
 
     if method_name=='ensemble':
-        
-        n_labels = np.sum([len(labeled_inds[i]) for
-                           i in range(len(labeled_inds))])
 
+        member_posts = ensemble_posteriors_multimg(
+            expr, sess, all_padded_imgs, 
+            pool_inds, labeled_inds)
         av_posts = 0
-        x_feed_dict = {expr.model_holder.keep_prob: 1.}
-        for i in range(len(expr.pretrained_paths)):
-            if n_labels==0:
-                # if no labeled indices, go for ensemble
-                # of pre-trained models
-                expr.model_holder.perform_assign_ops(
-                    expr.pretrained_paths[i], sess)
-            else:
-                # otherwise, create the ensemble by
-                # fine-tuning the previous model multiple
-                # times
-                expr.model_holder.perform_assign_ops(
-                    expr.prev_weights_path, sess)
-                PW_AL.finetune_multimg(expr,
-                                       expr.model_holder, 
-                                       sess,
-                                       all_padded_imgs,
-                                       labeled_inds)
-
-            # compute posteriors with the current model
-            # of the ensemble
-            posts = bin_uncertainty_filter_multimg(
-                expr, expr.model_holder, sess, 
-                all_padded_imgs,
-                pool_inds, k, x_feed_dict)
-            av_posts = (posts+i*av_posts)/(i+1)
+        for i in range(len(member_posts)):
+            av_posts = (member_posts[i]+i*av_posts)/(i+1)
 
         # sorting w.r.t uncertainty
         inds = np.argsort(np.abs(av_posts-.5))[:k]
 
-        Q_inds = patch_utils.global2local_inds(
-            inds, img_ind_sizes)
+        Q_inds = pool_inds.global2local(inds)
 
     if method_name=='QBC-JS':
-        
-        n_labels = np.sum([len(labeled_inds[i]) for
-                           i in range(len(labeled_inds))])
 
+        member_posts = ensemble_posteriors_multimg(
+            expr, sess, all_padded_imgs, 
+            pool_inds, labeled_inds)
         av_posts = 0
         av_ents = 0
-        x_feed_dict = {expr.model_holder.keep_prob: 1.}
-        for i in range(len(expr.pretrained_paths)):
-            if n_labels==0:
-                # if no labeled indices, go for ensemble
-                # of pre-trained models
-                expr.model_holder.perform_assign_ops(
-                    expr.pretrained_paths[i], sess)
-            else:
-                # otherwise, create the ensemble by
-                # fine-tuning the previous model multiple
-                # times
-                expr.model_holder.perform_assign_ops(
-                    expr.prev_weights_path, sess)
-                PW_AL.finetune_multimg(expr,
-                                       expr.model_holder, 
-                                       sess,
-                                       all_padded_imgs,
-                                       labeled_inds)
-
-            # compute posteriors with the current model
-            # of the ensemble
-            posts = bin_uncertainty_filter_multimg(
-                expr, expr.model_holder, sess, 
-                all_padded_imgs,
-                pool_inds, k, x_feed_dict)
-            av_posts = (posts+i*av_posts)/(i+1)
-
-            neg_posts = 1-posts
-            posts[posts==0] += 1e-6
-            neg_posts[neg_posts==0] += 1e-6
-            ents = -posts*np.log(posts) -\
-                  neg_posts*np.log(neg_posts)
+        for i in range(len(member_posts)):
+            av_posts = (member_posts[i]+i*av_posts)/(i+1)
             # average entropies
+            ents = PW_NN.binary_entropy(member_posts[i])
             av_ents = (ents+i*av_ents)/(i+1)
 
         # entropy of average posteriors
-        av_neg_posts = 1-av_posts
-        av_posts[av_posts==0] += 1e-6
-        av_neg_posts[av_neg_posts==0] += 1e-6
-        ent_av_posts = -av_posts*np.log(av_posts)-\
-                       av_neg_posts*np.log(av_neg_posts)
+        ent_av_posts = PW_NN.binary_entropy(av_posts)
 
         scores = ent_av_posts - av_ents
         inds = np.argsort(-scores)[:k]
 
-        Q_inds = patch_utils.global2local_inds(
-            inds, img_ind_sizes)
+        Q_inds = pool_inds.global2local(inds)
 
     if method_name=='fi':
         # uncertainty-filtering
@@ -551,7 +563,7 @@ def query_multimg(expr,
             pool_inds, B)
 
         # loading patches
-        img_inds = [np.array(pool_inds[i])[sel_inds[i]]
+        img_inds = [pool_inds[i][sel_inds[i]]
                     for i in range(len(pool_inds))]
         patches,_ = patch_utils.get_patches_multimg(
             all_padded_imgs, img_inds,
@@ -595,6 +607,37 @@ def query_multimg(expr,
         #    axis=1), F.shape[1], axis=1)
         ref_F = []
 
+    if method_name=='fi-llfc':
+        # features and posteriors in one pass
+        F = [[] for i in range(len(pool_inds))]
+        posts = [[] for i in range(len(pool_inds))]
+        for i in range(len(pool_inds)):
+            F[i], posts[i] = evals.get(
+                i, ['feature_layer', 'posteriors'])
+
+        # uncertainty-filtering
+        sel_inds,sel_posts = bin_uncertainty_filter_multimg(
+            expr, model, sess, all_padded_imgs,
+            pool_inds, B, posts=posts)
+        sel_F = np.concatenate(
+            [F[i][:,sel_inds[i]] for i in range(len(F))], axis=1)
+        sel_posts = np.concatenate(sel_posts)
+        del F, posts
+
+        # closed-form A-matrices of the last layer
+        # over a subset of the feature components
+        if 'llfc_dim' in expr.pars and expr.pars['llfc_dim']:
+            llfc_dim = expr.pars['llfc_dim']
+        else:
+            llfc_dim = 10
+        nnz_feats = np.sum(sel_F>0, axis=1)
+        feat_inds = np.argsort(-nnz_feats, kind='mergesort')[:llfc_dim]
+        A = gen_llfc_A_matrices(sel_F[feat_inds,:],
+                                sel_posts,
+                                1e-3)
+        ref_F = []
+
+    if method_name in ['fi', 'fi-llfc']:
         # SDP
         # ----
         lambda_ = expr.pars['lambda_']
@@ -613,8 +656,34 @@ def query_multimg(expr,
             q_opt = soln[0]
             obj_val = soln[1]
             
+        elif expr.pars['SDP_solver'] in ['FW', 'MD']:
+            # first-order solvers, with an optional
+            # iteration/time budget, warm-started by
+            # the solution of the previous query of
+            # this method (over the candidates that
+            # are still in the pool)
+            max_iters = expr.pars['FO_max_iters'] if \
+                        'FO_max_iters' in expr.pars and \
+                        expr.pars['FO_max_iters'] else 1000
+            time_limit = expr.pars['FO_time_limit'] if \
+                         'FO_time_limit' in expr.pars else None
+            cands = [(i, v) for i in range(len(sel_inds))
+                     for v in pool_inds[i][sel_inds[i]]]
+            if not(hasattr(expr, 'FO_warm_starts')):
+                expr.FO_warm_starts = {}
+            prev_q = expr.FO_warm_starts.get(method_name, {})
+            q0 = np.array([prev_q.get(cand, 0.) for cand in cands])
+            if not(np.any(q0>0)):
+                q0 = None
+            q_opt, info = NNAL_tools.first_order_query_distribution(
+                A, q0=q0, method=expr.pars['SDP_solver'],
+                max_iters=max_iters, time_limit=time_limit)
+            expr.FO_warm_starts[method_name] = {
+                cand: q for cand, q in zip(cands, q_opt) if q>0}
+            #print('status: %s (gap: %f)'% (info['status'], 
+            #                               info['gap']), end='\n\t')
+            obj_val = info['objective']
 
-        pdb.set_trace()
         # sampling from the optimal solution
         draws = NNAL_tools.sample_query_dstr(
             q_opt, k, replacement=True)
@@ -630,35 +699,24 @@ def query_multimg(expr,
 
 
 def get_HV_inds(padded_img, patch_shape, 
-                thr, pool_inds):
+                thr, pool_inds, var_map=None):
     """Getting the local indices of the pool samples
     that have local variance higher than a threshold
     (the output are indices of the samples in terms
     their location in the `pool_inds` array)
-    """
 
-    rads = np.int8((np.array(patch_shape)-1)/2)
-    # use T1 to compute the variances
-    (d1,d2,d3) = padded_img.shape
-    # un-padding
-    img_1 = padded_img[rads[0]:d1-rads[0],
-                       rads[1]:d2-rads[1],
-                       rads[2]:d3-rads[2]]
+    The variance map of the image (see `get_var_map`)
+    can be given in `var_map` if it is already 
+    computed.
+    """
 
-    # compute 2D variance map
-    # (choosing first component of
-    # the patch shape as the radius of
-    # the loal variance computation)
-    var_map = np.zeros(img_1.shape)
-    for i in range(img_1.shape[2]):
-        slice_var = patch_utils.get_vars_2d(
-            img_1[:,:,i], rads[0])
-        var_map[:,:,i] = slice_var
+    if var_map is None:
+        var_map = get_var_map(padded_img, patch_shape)
 
     # get variance scores of 
     # all given pool indices
     pool_multinds = np.unravel_index(
-        pool_inds, img_1.shape)
+        pool_inds, var_map.shape)
     inds_vscores = var_map[pool_multinds]
 
     # filter-out the low-variance 
@@ -668,6 +726,55 @@ def get_HV_inds(padded_img, patch_shape,
 
     return valid_pool_inds
 
+def get_var_map(padded_img, patch_shape):
+    """Local variance map of the (un-padded) image
+    over its 2D axial slices, choosing the first
+    component of the patch radius as the size of
+    the windows
+    """
+
+    rads = np.int8((np.array(patch_shape)-1)/2)
+    (d1,d2,d3) = padded_img.shape
+    # un-padding
+    img_1 = padded_img[rads[0]:d1-rads[0],
+                       rads[1]:d2-rads[1],
+                       rads[2]:d3-rads[2]]
+
+    return patch_utils.get_local_vars(img_1, rads[0])
+
+def get_var_map_multimg(expr, all_padded_imgs, i):
+    """Variance map of the first modality of the i-th
+    subject of a multi-image experiment (see
+    `get_var_map`)
+
+    The images of an experiment do not change, so
+    the maps are computed only once and saved in the
+    experiment's directory (under `var_maps/`) for
+    the later iterations and runs.
+    """
+
+    if not(hasattr(expr, 'var_maps')):
+        expr.var_maps = {}
+    rads = np.int8((np.array(expr.pars['patch_shape'])-1)/2)
+    key = (i, int(rads[0]))
+    if key in expr.var_maps:
+        return expr.var_maps[key]
+
+    maps_dir = os.path.join(expr.root_dir, 'var_maps')
+    map_path = os.path.join(maps_dir, 
+                            'var_map_%d_r%d.npy'% key)
+    if os.path.exists(map_path):
+        var_map = np.load(map_path, mmap_mode='r')
+    else:
+        var_map = get_var_map(all_padded_imgs[i][0],
+                              expr.pars['patch_shape'])
+        if not(os.path.exists(maps_dir)):
+            os.makedirs(maps_dir)
+        np.save(map_path, var_map)
+    expr.var_maps[key] = var_map
+
+    return var_map
+
 def binary_uncertainty_filter(posts, B):
     """Uncertainty filtering for binary class
     label distribution
@@ -687,25 +794,62 @@ def bin_uncertainty_filter_multimg(expr,
                                    all_padded_imgs,
                                    pool_inds,
                                    B,
-                                   x_feed_dict={}):
+                                   x_feed_dict={},
+                                   posts=None):
+    """Selecting the `B` most uncertain samples
+    of the pool of multiple images
+
+    If the posteriors of the pool samples are 
+    already computed (e.g. together with other
+    variables), they can be given in `posts` as
+    a list (one array per image) to avoid 
+    evaluating them again.
+
+    The selection is streamed (see 
+    `patch_utils.TopBSelector`), hence posteriors
+    of the whole pool are never kept together.
+    Only if an extra feed-dictionary is given, the
+    posteriors of all the pool are returned instead.
+    """
 
-    # computing entropies for voxels of each
-    # image separately
+    if not(isinstance(pool_inds, patch_utils.PoolIndex)):
+        pool_inds = patch_utils.PoolIndex(pool_inds)
     s = len(pool_inds)
-    img_ind_sizes = [len(pool_inds[i]) for i in range(s)]
     m = len(all_padded_imgs[0])-1
-    n = np.sum(img_ind_sizes)
     H = [[] for i in range(s)]
+    selector = patch_utils.TopBSelector(
+        B, s, key=lambda p: np.abs(p-.5))
     for i in range(s):
         if len(pool_inds[i])==0:
             continue
+        if posts is not None:
+            H[i] = posts[i]
+            selector.push(posts[i], 
+                          np.arange(len(posts[i])), i)
+            continue
 
         # set the stats
         stats = []
         for j in range(m):
             stats += [[expr.train_stats[i,2*j],
                        expr.train_stats[i,2*j+1]]]
-        posts = PW_NN.batch_eval(
+        if len(x_feed_dict)>0:
+            H[i] = PW_NN.batch_eval(
+                model,
+                sess,
+                all_padded_imgs[i][:-1],
+                pool_inds[i],
+                expr.pars['patch_shape'],
+                expr.pars['ntb'],
+                stats,
+                'posteriors',
+                None,
+                x_feed_dict,
+                vol_ind=get_vol_ind(model, i),
+                patch_bank=get_patch_bank(expr, i))[0]
+            continue
+
+        PW_NN.batch_eval(
             model,
             sess,
             all_padded_imgs[i][:-1],
@@ -714,26 +858,149 @@ def bin_uncertainty_filter_multimg(expr,
             expr.pars['ntb'],
             stats,
             'posteriors',
-            None,
-            x_feed_dict)[0]
-
-        H[i] = list(posts)
+            vol_ind=get_vol_ind(model, i),
+            patch_bank=get_patch_bank(expr, i),
+            selector=lambda p, b: selector.push(p, b, i))
 
     # spit out only the posteriors only if 
     # extra-feed-dict is given
-    tH = np.concatenate(H)
     if len(x_feed_dict)>0:
-        return tH
+        return np.concatenate(H)
+
+    return selector.result()
+
+def model_version(model, sess):
+    """Digest of the current weights of a model, to
+    be used as a key for caching values that depend
+    on the model
+    """
+
+    digest = hashlib.sha1()
+    for layer_name in sorted(model.var_dict):
+        for val in sess.run(model.var_dict[layer_name]):
+            digest.update(np.ascontiguousarray(val).tobytes())
+
+    return digest.hexdigest()
+
+def core_set_cache_path(expr, model, sess, pool_inds, labeled_inds):
+    """Path to the cached minimum distances of the 
+    pool samples to the labeled ones in core-set
+    querying, keyed by the model version (see 
+    `model_version`), the labeled samples and the pool
+    """
+
+    digest = hashlib.sha1(model_version(model, sess).encode())
+    for i in range(len(labeled_inds)):
+        digest.update(str(expr.labeled_paths[i]).encode())
+        digest.update(np.array(labeled_inds[i], dtype=int).tobytes())
+    for i in range(len(pool_inds)):
+        digest.update(np.array(pool_inds[i], dtype=int).tobytes())
+
+    return os.path.join(expr.root_dir, 'core-set', 
+                        'min_dists_%s.npy'% digest.hexdigest())
+
+def save_core_set_cache(cache_path, min_dists):
+    """Saving the minimum distances of core-set 
+    querying, and removing the other (outdated) 
+    cached distances
+    """
+
+    cache_dir = os.path.dirname(cache_path)
+    if not(os.path.exists(cache_dir)):
+        os.makedirs(cache_dir)
+    for f in os.listdir(cache_dir):
+        if f.startswith('min_dists_') and f.endswith('.npy'):
+            os.remove(os.path.join(cache_dir, f))
+    np.save(cache_path, min_dists)
+
+def ensemble_posteriors_multimg(expr,
+                                sess,
+                                all_padded_imgs,
+                                pool_inds,
+                                labeled_inds):
+    """Computing posteriors (of being masked) of the
+    pool samples for all members of the ensemble,
+    returned as an array with one row per member
+
+    If there is no labeled sample, the members are 
+    the pre-trained models in `expr.pretrained_paths`;
+    otherwise, they are created by fine-tuning the
+    previous model multiple times.
+
+    If the experiment has a stacked ensemble (see
+    `NN_extended.ModelEnsemble`) in `expr.ensemble`, 
+    the weights of all the members are set first, and
+    then all of them are evaluated over the pool in a
+    single pass. Otherwise, `expr.model_holder` takes
+    the weights of each member in turn and the pool
+    is evaluated once per member.
+    """
+
+    if not(isinstance(pool_inds, patch_utils.PoolIndex)):
+        pool_inds = patch_utils.PoolIndex(pool_inds)
+    n_labels = np.sum([len(labeled_inds[i]) for
+                       i in range(len(labeled_inds))])
+    ensemble = getattr(expr, 'ensemble', None)
+
+    member_posts = []
+    x_feed_dict = {expr.model_holder.keep_prob: 1.}
+    for i in range(len(expr.pretrained_paths)):
+        if n_labels==0:
+            # if no labeled indices, go for ensemble
+            # of pre-trained models
+            if ensemble is not None:
+                ensemble.load_member(
+                    i, expr.pretrained_paths[i], sess)
+                continue
+            expr.model_holder.perform_assign_ops(
+                expr.pretrained_paths[i], sess)
+        else:
+            # otherwise, create the ensemble by
+            # fine-tuning the previous model multiple
+            # times
+            expr.model_holder.perform_assign_ops(
+                expr.prev_weights_path, sess)
+            PW_AL.finetune_multimg(expr,
+                                   expr.model_holder, 
+                                   sess,
+                                   all_padded_imgs,
+                                   labeled_inds)
+            if ensemble is not None:
+                ensemble.copy_member(i, sess)
+                continue
 
-    # sort with respect to entropy values
-    tH = np.abs(tH - 0.5)
-    sorted_inds = np.argsort(tH)[:B]
-    sel_inds = patch_utils.global2local_inds(
-        sorted_inds, img_ind_sizes)
-    sel_posts = [np.array(H[i])[sel_inds[i]] 
-                 for i in range(s)]
+        # compute posteriors with the current model
+        # of the ensemble
+        member_posts += [bin_uncertainty_filter_multimg(
+            expr, expr.model_holder, sess, 
+            all_padded_imgs,
+            pool_inds, 0, x_feed_dict)]
 
-    return sel_inds, sel_posts
+    if ensemble is None:
+        return np.array(member_posts)
+
+    # all the members at once
+    m = len(all_padded_imgs[0])-1
+    for i in range(len(pool_inds)):
+        if len(pool_inds[i])==0:
+            continue
+        stats = []
+        for j in range(m):
+            stats += [[expr.train_stats[i,2*j],
+                       expr.train_stats[i,2*j+1]]]
+        member_posts += [PW_NN.batch_eval(
+            ensemble,
+            sess,
+            all_padded_imgs[i][:-1],
+            pool_inds[i],
+            expr.pars['patch_shape'],
+            expr.pars['ntb'],
+            stats,
+            'member_posteriors',
+            vol_ind=get_vol_ind(ensemble, i),
+            patch_bank=get_patch_bank(expr, i))[0]]
+
+    return np.concatenate(member_posts, axis=1)
 
 def gen_A_matrices(expr, 
                    model, 
@@ -749,66 +1016,35 @@ def gen_A_matrices(expr,
     # weights and bias terms --> number of layers that
     # are considered is obtained after dividing by 2
     A_size = int(len(model.grad_posts['1'])/2)
-    d3 = expr.pars['patch_shape'][-1]
-    c = expr.nclass
     A = []
 
+    # class-conditional gradients of all the samples
+    grads_0, grads_1 = get_sample_gradients(
+        expr, model, sess, sel_patches)
+
     # len(sel_posts) == sel_patches.shape[0]
     for i in range(len(sel_posts)):
 
-        # normalizing the patch
-        X_i = sel_patches[i,:,:,:]
-
-        feed_dict = {
-            model.x: np.expand_dims(X_i,axis=0),
-            model.keep_prob: 1.}
-
         # preparing the poserior
         # ASSUMOTION: binary classifications
         x_post = sel_posts[i]
-        # Computing gradients and shrinkage
+        # gradients of a class with (almost) zero
+        # posterior are not used
         if x_post < 1e-6:
             x_post = 0.
-
-            grads_0 = sess.run(
-                model.grad_posts['0'],
-                feed_dict=feed_dict)
-
-            grads_0 =  NNAL_tools.\
-                       shrink_gradient(
-                           grads_0, 'sum')
-            grads_1 = 0.
-
+            g0 = grads_0[i,:]
+            g1 = 0.
         elif x_post > 1-1e-6:
             x_post = 1.
-
-            grads_0 = 0.
-
-            grads_1 = sess.run(
-                model.grad_posts['1'],
-                feed_dict=feed_dict)
-
-            grads_1 = NNAL_tools.\
-                      shrink_gradient(
-                          grads_1, 'sum')
+            g0 = 0.
+            g1 = grads_1[i,:]
         else:
-            grads_0 = sess.run(
-                model.grad_posts['0'],
-                feed_dict=feed_dict)
-            grads_0 =  NNAL_tools.\
-                       shrink_gradient(
-                           grads_0, 'sum')
-
-            grads_1 = sess.run(
-                model.grad_posts['1'],
-                feed_dict=feed_dict)
-            grads_1 =  NNAL_tools.\
-                       shrink_gradient(
-                           grads_1, 'sum')
+            g0 = grads_0[i,:]
+            g1 = grads_1[i,:]
 
         # the A-matrix
-        Ai = (1.-x_post) * np.outer(grads_0, grads_0) + \
-             x_post * np.outer(grads_1, grads_1)
+        Ai = (1.-x_post) * np.outer(g0, g0) + \
+             x_post * np.outer(g1, g1)
 
         # final diagonal-loading
         A += [Ai+ np.eye(A_size)*diag_load]
@@ -816,6 +1052,91 @@ def gen_A_matrices(expr,
     return A
 
 
+def get_sample_gradients(expr, model, sess, patches):
+    """Computing class-conditional gradients of the
+    log-posteriors for a set of (normalized) patches,
+    shrunk similar to `NNAL_tools.shrink_gradient` (with
+    `'sum'` option)
+
+    Per-sample gradients are computed and shrunk inside
+    the graph for batches of patches at once through
+    `model.shrunk_batch_grad_posts`, which should be
+    formed beforehand (see `PW_AL` run methods), and
+    the batch size can be set by
+    `expr.pars['grad_batch_size']` (default: 10).
+
+    The output is a pair of arrays (one per class),
+    each of size `n x A_size`, with `n` the number of
+    patches.
+    """
+
+    if not(hasattr(model, 'shrunk_batch_grad_posts')):
+        raise ValueError('Shrunk per-sample gradients of the model '+
+                         'should be formed (by `get_batch_gradients` '+
+                         "with shrink_method='sum') before the "+
+                         'graph is finalized.')
+    if 'grad_batch_size' in expr.pars and \
+       expr.pars['grad_batch_size']:
+        b = expr.pars['grad_batch_size']
+    else:
+        b = 10
+
+    A_size = int(len(model.grad_posts['1'])/2)
+    n = patches.shape[0]
+    grads = [np.zeros((n, A_size)), np.zeros((n, A_size))]
+    for t in range(0, n, b):
+        feed_dict = {model.x: patches[t:t+b,:,:,:],
+                     model.keep_prob: 1.}
+        grads[0][t:t+b,:], grads[1][t:t+b,:] = sess.run(
+            [model.shrunk_batch_grad_posts['0'],
+             model.shrunk_batch_grad_posts['1']],
+            feed_dict=feed_dict)
+
+    return grads
+
+
+def gen_llfc_A_matrices(F, posts, diag_load=1e-5, factors=False):
+    """Forming A-matrices (conditional Fisher information)
+    of the parameters of the last (FC) layer in closed form,
+    directly from the inputs to this layer and the posteriors
+
+    For a soft-max output, gradient of the log-posterior of
+    class `y` with respect to the last layer's weights and
+    bias is `(e_y - pi) x [u; 1]` (see `NN.LLFC_grads`), with
+    `u` the input to the layer. Hence the (binary) Fisher
+    information is `p(1-p) [u;1][u;1]^T` per class block;
+    only one block is kept since the two are identical (up
+    to the sign) due to the redundancy of soft-max.
+
+    :Parameters:
+
+        **F** : 2D array
+            inputs to the last layer (possibly only a subset
+            of their components) as columns, one per sample
+
+        **posts** : 1D array
+            posteriors of the first class (binary
+            classification)
+
+        **factors** : boolean (default: False)
+            if True, the rank-one factors `g_i` of the
+            A-matrices (without diagonal loading) are
+            returned as rows of a 2D array, instead of
+            the matrices `A_i = g_i g_i^T + diag_load*I`
+    """
+
+    n = F.shape[1]
+    U = np.concatenate((F.T, np.ones((n,1))), axis=1)
+    G = np.sqrt(posts*(1.-posts))[:,np.newaxis] * U
+    if factors:
+        return G
+
+    A = np.einsum('ij,ik->ijk', G, G)
+    A += diag_load*np.eye(U.shape[1])
+
+    return list(A)
+
+
 def refine_feature_matrix(F, B):
     """Refining a feature matrix to make it
     full row-rank with a moderate condition number
@@ -1038,7 +1359,7 @@ def draw_queries(qdist, prior, k,
 
     return Q_inds
 
-def get_self_sims(F):
+def get_self_sims(F, n_threads=1):
     """Computing representativeness of
     all members of a set described by
     the given feature vectors
@@ -1048,92 +1369,22 @@ def get_self_sims(F):
     represents features of the i'th 
     sample in the set.
     """
-    
-    # size of the chunk for computing
-    # pairwise similarities
-    b = 5000
-    n = F.shape[1]
-    
-    # dividing indices into chunks
-    ind_chunks = np.arange(
-        0, n, b)
-    if not(ind_chunks[-1]==n):
-        ind_chunks = np.append(
-            ind_chunks, n)
-
-    reps = np.zeros(n)
-    for i in range(len(ind_chunks)-1):
-        Fp = F[:,ind_chunks[i]:
-               ind_chunks[i+1]]
-        chunk_size = ind_chunks[i+1]-\
-                     ind_chunks[i]
-        
-        norms_p = np.sqrt(np.sum(
-            Fp**2, axis=0))
-        norms = np.sqrt(np.sum(
-            F**2, axis=0))
-        # inner product
-        dots = np.dot(Fp.T, F)
-        # outer-product of norms to
-        # be used in the denominator
-        norms_outer = np.outer(
-            norms_p, norms)
-        sims = dots / norms_outer
-        
-        # make the self-similarity 
-        # -inf to ignore it
-        sims[np.arange(chunk_size),
-             np.arange(
-                 ind_chunks[i],
-                 ind_chunks[i+1])] = -np.inf
-        
-        # loading similarities
-        reps[ind_chunks[i]:
-             ind_chunks[i+1]] = np.max(
-                 sims, axis=1)
 
-    return reps
+    X = sim_utils.normalize_features(F)
 
-def get_cross_sims(F1, F2):
+    return sim_utils.reduce_sims(X, exclude_self=True,
+                                 n_threads=n_threads)
+
+def get_cross_sims(F1, F2, n_threads=1):
     """Computing similarities between
     individual members of  one set and 
     another set
     """
 
-    b  = 5000
-    n1 = F1.shape[1]
-    n2 = F2.shape[1]
-
-    # dividing indices into chunks
-    ind_chunks = np.arange(
-        0, n1, b)
-    if not(ind_chunks[-1]==n1):
-        ind_chunks = np.append(
-            ind_chunks, n1)
-
-    reps = np.zeros(n1)
-    for i in range(len(ind_chunks)-1):
-        Fp1 = F1[:,ind_chunks[i]:
-                 ind_chunks[i+1]]
-        
-        norms_p1 = np.sqrt(np.sum(
-            Fp1**2, axis=0))
-        norms_2 = np.sqrt(np.sum(
-            F2**2, axis=0))
-        # inner product
-        dots = np.dot(Fp1.T, F2)
-        # outer-product of norms to
-        # be used in the denominator
-        norms_outer = np.outer(
-            norms_p1, norms_2)
-        sims = dots / norms_outer
-
-        # loading the parameters
-        reps[ind_chunks[i]:
-             ind_chunks[i+1]] = np.max(
-                 sims, axis=1)
-
-    return reps    
+    X1 = sim_utils.normalize_features(F1)
+    X2 = sim_utils.normalize_features(F2)
+
+    return sim_utils.reduce_sims(X1, X2, n_threads=n_threads)
 
 def get_confident_samples(expr,
                           run,
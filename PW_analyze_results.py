@@ -20,6 +20,7 @@ import os
 
 import tensorflow as tf
 import patch_utils
+import sim_utils
 import PW_NNAL
 import PW_NN
 import PW_AL
@@ -682,7 +683,7 @@ def full_slice_eval(model,
     in a few slices of a given image
     """
     
-    img,_ = nrrd.read(img_paths[0])
+    img = patch_utils.load_padded_volume(img_paths[0])
     img_shape = img.shape
     slice_nvox = np.prod(img_shape[:2])
 
@@ -911,10 +912,7 @@ def get_Qsims(model,sess, expr, method_name):
                      feed_dict={model.x:patches,
                                 model.keep_prob:1.})
         # cosine similarities
-        inners = np.dot(F.T,F)
-        norms = np.sqrt(np.sum(F**2, axis=0))
-        cos_sims = inners / np.outer(norms,norms)
-
-        sims += [cos_sims]
+        X = sim_utils.normalize_features(F)
+        sims += [sim_utils.cosine_sims(X)]
 
     return sims
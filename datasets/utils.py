@@ -246,18 +246,8 @@ def global2local_inds(batch_inds,
     are located before the target i-th set
     """
 
-    cumvols = np.append(
-        -1, np.cumsum(set_sizes)-1)
-    
-    # finding the set indices 
-    set_inds = cumvols.searchsorted(
-        batch_inds) - 1
-    # local index for each set
-    local_inds = [np.array(batch_inds)[
-        set_inds==i]-cumvols[i]-1 for i in
-                  range(len(set_sizes))]
-
-    return local_inds
+    return patch_utils.global2local_inds(
+        batch_inds, set_sizes)
 
 def nrrd_reader(path):
     return nrrd.read(path)[0]
@@ -1,9 +1,12 @@
-from scipy.signal import convolve2d
+from collections import OrderedDict
 import numpy as np
 import warnings
 #import nibabel
 import nrrd
 import pdb
+import threading
+import queue
+import time
 import csv
 import os
 
@@ -183,6 +186,99 @@ def generate_grid_samples(img_addr, mask_addr,
     
     return inds_3D, labels, types
 
+class PaddedVolumeCache(object):
+    """Process-wide cache of (padded) image volumes
+
+    Volumes are read from NRRD files, optionally
+    converted to a given data type and zero-padded 
+    with the given radii, and kept in memory under
+    the key `(path, radii, dtype)`. When the total
+    size of the cached volumes exceeds the byte
+    budget, the least recently used volumes are
+    dropped.
+
+    The returned arrays are shared between all the
+    callers, hence they are made read-only.
+    """
+
+    def __init__(self, max_bytes=8*2**30):
+
+        self.max_bytes = max_bytes
+        self.volumes = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, rads=(0,0,0), dtype=None):
+        """Getting the volume stored in `path`,
+        padded with `rads` along the three axes 
+        and casted into `dtype` (if given)
+        """
+
+        rads = tuple(int(r) for r in rads)
+        key = (os.path.abspath(path), rads, 
+               None if dtype is None else np.dtype(dtype).str)
+
+        with self.lock:
+            if key in self.volumes:
+                self.volumes.move_to_end(key)
+                self.hits += 1
+                return self.volumes[key]
+            self.misses += 1
+
+        img,_ = nrrd.read(path)
+        if dtype is not None:
+            img = np.asarray(img, dtype=dtype)
+        if any(rads):
+            img = np.pad(
+                img, 
+                ((rads[0],rads[0]),
+                 (rads[1],rads[1]),
+                 (rads[2],rads[2])),
+                'constant')
+        img.flags.writeable = False
+
+        with self.lock:
+            # volumes larger than the whole budget
+            # are returned without being cached
+            if key not in self.volumes and \
+               img.nbytes <= self.max_bytes:
+                self.volumes[key] = img
+                self.nbytes += img.nbytes
+                self.evict()
+
+        return img
+
+    def evict(self):
+        """Dropping the least recently used volumes
+        until the cache fits in the byte budget
+        (should be called while holding the lock)
+        """
+        
+        while self.nbytes > self.max_bytes:
+            _, img = self.volumes.popitem(last=False)
+            self.nbytes -= img.nbytes
+
+    def set_budget(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.volumes.clear()
+            self.nbytes = 0
+
+volume_cache = PaddedVolumeCache()
+
+def load_padded_volume(path, rads=(0,0,0), dtype=None):
+    """Loading a (padded) volume through the
+    process-wide cache `volume_cache`
+    """
+    
+    return volume_cache.get(path, rads, dtype)
+
 def get_batches(inds_dict,
                 batch_size):
     """Divide a given set of image indices and
@@ -215,82 +311,134 @@ def get_batch_vars(inds_dict,
     have odd elements so that the radious 
     along each direction will be an integer
     and no shape mismatch will happen.
+
+    For extracting several batches from the 
+    same dictionaries, use a `DictBatchLoader`
+    directly, which avoids converting the 
+    dictionaries for every batch.
     """
 
-    # initializing variables
-    b = len(batch_inds)
-    batch_tensors = np.zeros(
-        (b,)+patch_shape)
-    batch_labels = np.zeros((2,b))
-
-    # locating batch indices inside
-    # the data dictionaries
-    sub_dict = locate_in_dict(inds_dict,
-                              batch_inds)
-    # calculating radii of the patch
-    rads = np.zeros(3,dtype=int)
-    for i in range(3):
-        rads[i] = int((patch_shape[i]-1)/2.)
+    loader = DictBatchLoader(inds_dict,
+                             labels_dict,
+                             patch_shape)
+
+    return loader.get_batch(batch_inds)
+
+class DictBatchLoader(object):
+    """Class for loading batches of patches and
+    labels from data dictionaries 
+
+    The data dictionaries (`inds_dict` and 
+    `labels_dict`) have the same structure as
+    those used in `get_batch_vars` and 
+    `locate_in_dict`, i.e. image paths as the keys
+    and voxel indices (or their labels) as the
+    items. Global batch indices refer to the items
+    in the same order as they are saved in the
+    dictionaries.
+
+    Each image is read and padded only once for
+    the life time of the loader (through the 
+    process-wide volume cache), and the patches
+    of all modalities of a batch are gathered at
+    once. If the data has more than one modality,
+    `mod_paths` should map each key to the list of
+    paths of all its modalities (key path included).
+    """
 
-    # extracting patches from the image
-    cnt = 0
-    for img_path in list(sub_dict.keys()):
-        img,_ = nrrd.read(img_path)
-        # padding with the patch radius 
-        # so that all patch indices 
-        # fall in the limits of the image
-        # (skip the z-direction, for now)
-        padded_img = np.pad(
-            img, 
-            ((rads[0],rads[0]),
-             (rads[1],rads[1]),
-             (rads[2],rads[2])),
-            'constant')
-
-        # indices in the batch that belong
-        # to the `img_path` (sub-batch inds)
-        subbatch_inds = sub_dict[img_path]
-        b_i = len(subbatch_inds)
-
-        # adding one-hot labels
-        sub_labels = np.array(labels_dict[
-            img_path])[subbatch_inds]
-        subhot = np.zeros((2,b_i))
-        subhot[0,sub_labels==0]=1
-        subhot[1,sub_labels==1]=1
-        batch_labels[
-            :,cnt:cnt+b_i] = subhot
-
-        # converting to multiple-3D indicse
-        imgbatch_inds = np.array(inds_dict[
-            img_path])[subbatch_inds]
-        multi_inds3D = np.unravel_index(
-            imgbatch_inds, img.shape)
-
-        # extracting tensors 
-        for i in range(b_i):
-            # multiple-indices of the
-            # centers change in the padded
-            # image; 
-            # an adjustment is needed 
-            center_vox = [
-                multi_inds3D[0][i]+rads[0],
-                multi_inds3D[1][i]+rads[1],
-                multi_inds3D[2][i]+rads[2]]
-
-            patch = padded_img[
-                center_vox[0]-rads[0]:
-                center_vox[0]+rads[0]+1,
-                center_vox[1]-rads[1]:
-                center_vox[1]+rads[1]+1,
-                center_vox[2]-rads[2]:
-                center_vox[2]+rads[2]+1]
-
-            batch_tensors[cnt,:,:,:] = patch
-
-            cnt += 1
-
-    return batch_tensors, batch_labels
+    def __init__(self, 
+                 inds_dict,
+                 labels_dict,
+                 patch_shape,
+                 mod_paths=None):
+
+        self.patch_shape = tuple(patch_shape)
+        self.rads = np.zeros(3,dtype=int)
+        for i in range(3):
+            self.rads[i] = int((patch_shape[i]-1)/2.)
+
+        self.keys = list(inds_dict.keys())
+        self.inds = [np.array(inds_dict[key]) 
+                     for key in self.keys]
+        self.labels = [np.array(labels_dict[key]) 
+                       for key in self.keys]
+        self.cumvols = np.cumsum(
+            [len(inds) for inds in self.inds])
+
+        if mod_paths is None:
+            mod_paths = {key:[key] for key in self.keys}
+        self.mod_paths = [mod_paths[key] 
+                          for key in self.keys]
+        # images will be loaded at the first
+        # time they are needed
+        self.padded_imgs = [None]*len(self.keys)
+        self.img_shapes = [None]*len(self.keys)
+
+    def load_images(self, key_ind):
+        
+        if self.padded_imgs[key_ind] is None:
+            self.padded_imgs[key_ind] = [
+                load_padded_volume(path, self.rads)
+                for path in self.mod_paths[key_ind]]
+            self.img_shapes[key_ind] = tuple(
+                np.array(self.padded_imgs[key_ind][0].shape)-
+                2*self.rads)
+        
+        return self.padded_imgs[key_ind]
+
+    def get_batch(self, batch_inds):
+        """Extracting patches and one-hot labels
+        of a batch of global indices
+
+        Similar to the (old) `get_batch_vars`, 
+        samples of the output are grouped by the
+        key they belong to (in the order of keys in
+        the dictionaries) and within each key keep
+        their order in `batch_inds`.
+        """
+
+        batch_inds = np.array(batch_inds, dtype=int)
+        b = len(batch_inds)
+        d1,d2,d3 = self.patch_shape
+        m = len(self.mod_paths[0])
+
+        # key of each index, and sorting them 
+        # by their keys
+        key_inds = np.searchsorted(
+            self.cumvols, batch_inds, side='right')
+        order = np.argsort(key_inds, kind='mergesort')
+        batch_inds = batch_inds[order]
+        key_inds = key_inds[order]
+        key_bounds = np.searchsorted(
+            key_inds, np.arange(len(self.keys)+1))
+        
+        batch_tensors = np.zeros((b,d1,d2,m*d3))
+        batch_labels = np.zeros((2,b))
+        for k in np.unique(key_inds):
+            s, e = key_bounds[k], key_bounds[k+1]
+            padded_imgs = self.load_images(k)
+
+            # indices with respect to this key
+            local_inds = batch_inds[s:e]
+            if k>0:
+                local_inds = local_inds - self.cumvols[k-1]
+
+            # one-hot labels
+            sub_labels = self.labels[k][local_inds]
+            batch_labels[0,s:e] = sub_labels==0
+            batch_labels[1,s:e] = sub_labels==1
+
+            # patches of all modalities
+            multinds = np.unravel_index(
+                self.inds[k][local_inds],
+                self.img_shapes[k])
+            for j in range(m):
+                windows = get_patch_windows(
+                    padded_imgs[j], self.patch_shape)
+                batch_tensors[s:e,:,:,j*d3:(j+1)*d3] = \
+                    windows[multinds]
+
+        return batch_tensors, batch_labels
 
 def get_patches_MultiModal(tr_data,
                            batch_inds,
@@ -299,50 +447,145 @@ def get_patches_MultiModal(tr_data,
     a given data with structure explained in
     the function `PW_NN.PW_train_epoch_MultiModal`
 
-    The function  loads patches of each modality
-    separately, and then merge them all together
+    The patches of all modalities are loaded
+    together, and merged in the last axis
     """
 
     # number of modalities
     m = len(tr_data[0])-2
-
     s = len(tr_data)
-    b = len(batch_inds)
-    MM_batches = np.zeros(
-        (b,) + patch_shape[:2] + (m,))
-
-    # load the data from the correponding
-    # modalities.. using the old 
-    # functions for single-modality 
-    # images that were using dictionaries
-    for j in range(m):
-        trinds_dict = {}
-        trlabels_dict = {}
-        for k in range(s):
-            trinds_dict.update(
-                {tr_data[k][j]:
-                 tr_data[k][-2]})
-            trlabels_dict.update(
-                {tr_data[k][j]:
-                 tr_data[k][-1]})
-
-        # get the batches
-        # we indeed, get the label multiple times
-        # because they don't change when we
-        # read batches from different modality
-        (batch_tensors,
-         batch_labels) = get_batch_vars(
-             trinds_dict,
-             trlabels_dict,
-             batch_inds,
-             patch_shape)
-
-        # normalizing the batches
-        MM_batches[:,:,:,j] = np.squeeze(
-            batch_tensors, axis=3)
-
-    return MM_batches, batch_labels
 
+    # dictionaries keyed by the first modality
+    trinds_dict = {}
+    trlabels_dict = {}
+    mod_paths = {}
+    for k in range(s):
+        trinds_dict.update(
+            {tr_data[k][0]: tr_data[k][-2]})
+        trlabels_dict.update(
+            {tr_data[k][0]: tr_data[k][-1]})
+        mod_paths.update(
+            {tr_data[k][0]: tr_data[k][:m]})
+
+    loader = DictBatchLoader(trinds_dict,
+                             trlabels_dict,
+                             patch_shape,
+                             mod_paths)
+
+    return loader.get_batch(batch_inds)
+
+
+class BatchPrefetcher(object):
+    """Class for preparing the batches of a 
+    training loop in a background thread
+
+    The batches are formed in the same way as
+    the training loops do, i.e. a random 
+    partitioning of the samples by 
+    `NN.gen_batch_inds` at the beginning of
+    each epoch, but the data of each batch 
+    (e.g. a feed-dictionary of patches and 
+    labels) is built by the given function
+    `make_batch` in a separate thread, while
+    the consumer is running the training step
+    of the previous batches. At most `depth`
+    batches are kept ready in a bounded queue. 
+
+    Iterating over the object gives tuples
+    `(t, i, batch)`, where `t` is the epoch,
+    `i` is the index of the batch in this 
+    epoch and `batch` is the output of 
+    `make_batch` for the indices of this 
+    batch. With `depth=0` no thread is used
+    and the batches are built in the loop.
+
+    If `shuffle=False`, the batches are 
+    consecutive chunks of the samples in their
+    original order (as used for evaluation).
+    """
+
+    def __init__(self, 
+                 make_batch,
+                 n,
+                 b,
+                 epochs=1,
+                 depth=2,
+                 shuffle=True):
+
+        self.make_batch = make_batch
+        self.n = n
+        self.b = b
+        self.epochs = epochs
+        self.depth = depth
+        self.shuffle = shuffle
+
+    def gen_batch_inds(self):
+        
+        if self.shuffle:
+            return NN.gen_batch_inds(self.n, self.b)
+        else:
+            return [np.arange(i, min(i+self.b, self.n))
+                    for i in range(0, self.n, self.b)]
+
+    def __iter__(self):
+
+        if self.depth < 1:
+            for t in range(self.epochs):
+                batch_inds = self.gen_batch_inds()
+                for i in range(len(batch_inds)):
+                    yield t, i, self.make_batch(batch_inds[i])
+            return
+
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.stop_event = threading.Event()
+        producer = threading.Thread(target=self.produce)
+        producer.daemon = True
+        producer.start()
+
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if item[0]=='error':
+                    raise item[1]
+                yield item[1:]
+        finally:
+            # stopping the producer if the consumer
+            # left the loop early
+            self.stop_event.set()
+            producer.join()
+
+    def produce(self):
+        """Filling the queue with the batches of
+        all epochs (to be run in the producer
+        thread)
+        """
+
+        try:
+            for t in range(self.epochs):
+                batch_inds = self.gen_batch_inds()
+                for i in range(len(batch_inds)):
+                    if self.stop_event.is_set():
+                        return
+                    self.put(('batch', t, i, 
+                              self.make_batch(batch_inds[i])))
+        except Exception as e:
+            self.put(('error', e))
+        finally:
+            self.put(None)
+
+    def put(self, item):
+        """Putting an item in the queue, unless
+        the consumer has stopped
+        """
+        
+        while not(self.stop_event.is_set()):
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
 
 def ravel_binary_mask(mask):
     """Reading and raveling masked indices
@@ -660,26 +903,30 @@ def sample_masked_volume(img,
     sel_inds = []
     sel_labels = []
     sel_types = []
+    # variance maps of all the slices 
+    # are computed at once
+    slice_view = {'axial':2, 'coronal':1, 'sagittal':0}[view]
+    var_map = get_local_vars(img, 5, slice_view)
     for s in slices:
         if view=='axial':
             img_slice = img[:,:,s]
             mask_slice = mask[:,:,s]
-            slice_view=2
+            var_slice = var_map[:,:,s]
         elif view=='coronal':
             img_slice = img[:,s,:]
             mask_slice = mask[:,s,:]
-            slice_view=1
+            var_slice = var_map[:,s,:]
         elif view=='sagittal':
             img_slice = img[s,:,:]
             mask_slice = mask[s,:,:]
-            slice_view=0
+            var_slice = var_map[s,:,:]
         
         # partitioning the 2D indices into
         # three groups:
         # (masked, structured non-masked,
         #  non-structured non-masked)
         (masked,Hvar,Lvar)=partition_2d_indices(
-            img_slice, mask_slice)
+            img_slice, mask_slice, var_slice)
         gmasked = expand_raveled_inds(
             masked, s, slice_view, img.shape)
         gHvar = expand_raveled_inds(
@@ -732,11 +979,15 @@ def sample_masked_volume(img,
             
     return sel_inds, sel_labels, sel_types
 
-def partition_2d_indices(img,mask):
+def partition_2d_indices(img,mask,var_map=None):
     """Partitioning an image into three
     different groups, based on the masked
     indices and variance of the patches around
     the pixels of the given 2D image
+
+    If the variance map of the image (with the
+    window size 5) is already computed, it can
+    be given in `var_map`.
     
     :Returns:
     
@@ -762,7 +1013,9 @@ def partition_2d_indices(img,mask):
 
     # computing the patch variance
     d = 5
-    var_map = get_vars_2d(img, d)
+    if var_map is None:
+        var_map = get_vars_2d(img, d)
+    var_map = np.array(var_map)
     var_map[var_map==0] += 1e-1
     var_map = np.log(var_map)
     var_thr = 2.
@@ -802,28 +1055,64 @@ def get_vars_2d(img,d):
     E[x] and E[x^2] using 2D convolution of
     the image and a dxd all-one matrix (kernel)
     where d here denotes the size of the patch
-    around each pixel.
+    around each pixel (see `get_local_vars`).
     """
-    
-    # making the image uint64 so that no
-    # precision problem happens when squaring
-    # up the intensities
-    img = np.uint64(img)
-    
-    # forming the kernel
-    kernel = np.ones((d,d))
-    
-    # E[x] -- mean of the patches
-    Ex = convolve2d(
-        img,kernel,'same') / float(d**2)
-    # E[x^2] -- mean of patch-squared
-    ExP2 = convolve2d(
-        img**2 ,kernel,'same') / float(d**2)
-    
-    # the variance
-    varx = ExP2 - Ex**2
-    
-    return varx
+
+    return get_local_vars(
+        np.expand_dims(img, axis=2), d)[:,:,0]
+
+
+def get_local_vars(img, d, axis=2):
+    """Variance map of all the 2D slices of a 3D 
+    image, computed at once
+
+    Slices are taken along the given axis (e.g.
+    `axis=2` for axial slices), and the variance
+    of each voxel is computed over the dxd window
+    around it within its slice, with zero values 
+    out of the image (the same windows as the 
+    `same` 2D convolution with a dxd kernel). 
+
+    The box filter is separable and computed by 
+    cumulative sums along each axis, hence the cost
+    per voxel does not depend on `d`. Sums are
+    accumulated in float64, and the map is returned
+    in float32.
+    """
+
+    axes = [ax for ax in range(3) if ax!=axis]
+    img = np.asarray(img, dtype=np.float64)
+
+    Ex = box_sums(box_sums(img, d, axes[0]), 
+                  d, axes[1]) / float(d**2)
+    ExP2 = box_sums(box_sums(img**2, d, axes[0]), 
+                    d, axes[1]) / float(d**2)
+
+    # round-off errors should not give 
+    # negative variances
+    varx = np.maximum(ExP2 - Ex**2, 0.)
+
+    return np.float32(varx)
+
+
+def box_sums(x, d, axis):
+    """Sums of the windows of length `d` along
+    an axis of an array, where the window of the
+    i-th element is `[i-d//2, i+d-1-d//2]`
+    (zero values out of the array)
+    """
+
+    n = x.shape[axis]
+    shape = list(x.shape)
+    shape[axis] = 1
+    csum = np.concatenate((np.zeros(shape),
+                           np.cumsum(x, axis=axis)), axis=axis)
+
+    lower = np.clip(np.arange(n) - d//2, 0, n)
+    upper = np.clip(np.arange(n) + d - d//2, 0, n)
+
+    return np.take(csum, upper, axis=axis) - \
+        np.take(csum, lower, axis=axis)
 
 
 def global2local_inds(batch_inds,
@@ -852,18 +1141,392 @@ def global2local_inds(batch_inds,
     are located before the target i-th set
     """
 
-    cumvols = np.append(
-        -1, np.cumsum(set_sizes)-1)
-    
-    # finding the set indices 
-    set_inds = cumvols.searchsorted(
-        batch_inds) - 1
-    # local index for each set
-    local_inds = [np.array(batch_inds)[
-        set_inds==i]-cumvols[i]-1 for i in
-                  range(len(set_sizes))]
+    return GlobalIndexMap(set_sizes).split_list(
+        batch_inds)
+
+class GlobalIndexMap(object):
+    """Class for converting global indices over
+    a sequence of ordered sets into local ones
+    (see `global2local_inds` for the definitions)
+
+    The cumulative offsets of the sets are 
+    computed once, and each batch of global 
+    indices is converted by a single search 
+    and a stable sort, hence the local indices
+    of each set keep their order in the batch. 
+    """
+
+    def __init__(self, set_sizes):
+
+        self.set_sizes = np.array(set_sizes, dtype=int)
+        self.offsets = np.append(
+            0, np.cumsum(self.set_sizes))
+
+    def __len__(self):
+        return len(self.set_sizes)
+
+    def split(self, batch_inds):
+        """Converting a batch of global indices
+        in CSR format
+
+        The output is a pair `(seg_offsets, 
+        local_inds)`, such that the local indices
+        of the i-th set are 
+        `local_inds[seg_offsets[i]:seg_offsets[i+1]]`
+        """
+
+        batch_inds = np.asarray(batch_inds, dtype=int)
+        set_inds = np.searchsorted(
+            self.offsets[1:], batch_inds, side='right')
+        order = np.argsort(set_inds, kind='mergesort')
+        set_inds = set_inds[order]
+        local_inds = batch_inds[order] - self.offsets[set_inds]
+        seg_offsets = np.searchsorted(
+            set_inds, np.arange(len(self.set_sizes)+1))
+
+        return seg_offsets, local_inds
+
+    def split_list(self, batch_inds):
+        """Same as `split`, but giving a list of 
+        local indices (views) for all the sets
+        """
+
+        seg_offsets, local_inds = self.split(batch_inds)
+
+        return [local_inds[seg_offsets[i]:seg_offsets[i+1]]
+                for i in range(len(self.set_sizes))]
+
+class PoolIndex(object):
+    """Class of the unlabeled pool of a multi-image
+    active learning experiment
+
+    The pool of each subject is a fixed set of
+    candidate voxels (e.g. the grid generated by
+    `PW_AL.gen_multimg_inds`) together with a 
+    boolean mask that shows which of them are
+    still in the pool (alive). Removing samples
+    only flips their bits, and the arrays of 
+    alive voxels, their sizes and the global
+    offsets are cached until the pool changes.
+
+    Indexing the object by a subject index gives
+    the (ordered) array of the alive voxel indices
+    of that subject, hence it can be used in place
+    of the list of index lists that we have been
+    using for the pools. Local indices refer to the
+    positions in these arrays, and global indices
+    refer to the positions in their concatenation
+    (see `global2local_inds`).
+    """
+
+    def __init__(self, grid_inds):
+
+        self.grids = [np.array(inds, dtype=int) 
+                      for inds in grid_inds]
+        self.alive = [np.ones(len(inds), dtype=bool) 
+                      for inds in self.grids]
+        # for locating voxel indices in the grids
+        self.sorters = [np.argsort(inds, kind='mergesort')
+                        for inds in self.grids]
+        self.reset_cache()
+
+    def reset_cache(self):
+        
+        self.positions = [None]*len(self.grids)
+        self.alive_inds = [None]*len(self.grids)
+        self.index_map = None
+
+    def __len__(self):
+        return len(self.grids)
+
+    def __getitem__(self, i):
+        """Alive voxel indices of the i-th subject
+        """
+
+        if self.alive_inds[i] is None:
+            self.alive_inds[i] = self.grids[i][
+                self.get_positions(i)]
+            self.alive_inds[i].flags.writeable = False
+
+        return self.alive_inds[i]
+
+    def get_positions(self, i):
+        """Locations of the alive voxels of the
+        i-th subject in its grid
+        """
+        
+        if self.positions[i] is None:
+            self.positions[i] = np.where(self.alive[i])[0]
 
-    return local_inds
+        return self.positions[i]
+
+    def sizes(self):
+        """Number of alive voxels of all subjects
+        """
+        
+        return self.get_index_map().set_sizes
+
+    def get_index_map(self):
+        """Global-to-local mapping of the current
+        pool (`GlobalIndexMap` object)
+        """
+
+        if self.index_map is None:
+            self.index_map = GlobalIndexMap(
+                [np.sum(alive) for alive in self.alive])
+
+        return self.index_map
+
+    def global2local(self, inds):
+        """Same as `global2local_inds` over the
+        current pool
+        """
+
+        return self.get_index_map().split_list(inds)
+
+    def remove(self, i, local_inds):
+        """Removing some samples of the i-th subject
+        from the pool given their local indices
+        """
+
+        if len(local_inds)==0:
+            return
+        self.alive[i][self.get_positions(i)[local_inds]] = False
+        self.positions[i] = None
+        self.alive_inds[i] = None
+        self.index_map = None
+
+    def remove_voxels(self, i, vox_inds, strict=True):
+        """Removing some samples of the i-th subject
+        from the pool given their voxel indices
+
+        If `strict` is False, the given voxels that
+        are not (or no longer) in the pool are simply
+        ignored instead of raising an error, e.g. to
+        reconcile a saved pool with the saved queries.
+        """
+
+        vox_inds = np.array(vox_inds, dtype=int)
+        if len(vox_inds)==0:
+            return
+        grid = self.grids[i]
+        locs = np.searchsorted(grid, vox_inds, 
+                               sorter=self.sorters[i])
+        locs[locs==len(grid)] = 0
+        positions = self.sorters[i][locs]
+        valid = (grid[positions]==vox_inds) & \
+                self.alive[i][positions]
+        if not(np.all(valid)):
+            if strict:
+                raise ValueError('Some of the given voxels are not '+
+                                 'in the pool of subject %d.'% i)
+            positions = positions[valid]
+            if len(positions)==0:
+                return
+        self.alive[i][positions] = False
+        self.positions[i] = None
+        self.alive_inds[i] = None
+        self.index_map = None
+
+    def save(self, file_path):
+        """Saving the pool in an `.npz` file, to be
+        loaded later by `PoolIndex.load`
+
+        The pool is first written into a temporary 
+        file which then replaces `file_path`, hence an
+        interrupted save never leaves a broken file.
+        """
+        
+        arrs = {}
+        for i in range(len(self.grids)):
+            arrs.update({'grid_%d'% i: self.grids[i],
+                         'alive_%d'% i: self.alive[i]})
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrs)
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path):
+
+        arrs = np.load(file_path)
+        s = len(arrs.files) // 2
+        pool = cls([arrs['grid_%d'% i] for i in range(s)])
+        pool.alive = [np.array(arrs['alive_%d'% i], dtype=bool)
+                      for i in range(s)]
+
+        return pool
+
+class TopBSelector(object):
+    """Streaming selection of the `B` best samples of
+    a (multi-subject) pool based on their scores
+
+    Scores are pushed batch by batch, together with
+    the subject and local indices of their samples,
+    and only the best `B` of them seen so far are 
+    kept in a buffer; hence the memory is O(B) no 
+    matter how large the pool is. The best samples
+    are those with the smallest `key(score)`, e.g.
+    `key=lambda p: np.abs(p-.5)` for the most
+    uncertain binary posteriors, or `key=np.negative`
+    for the largest scores.
+
+    The selection is the same as sorting keys of the
+    whole (concatenated) pool, with ties broken by
+    the position of the samples in the pool.
+    """
+
+    def __init__(self, B, n_subjects, key=None):
+
+        self.B = B
+        self.n_subjects = n_subjects
+        self.key = key
+
+        self.keys = np.zeros(0)
+        self.scores = np.zeros(0)
+        self.subjects = np.zeros(0, dtype=int)
+        self.local_inds = np.zeros(0, dtype=int)
+
+    def push(self, scores, local_inds, subject=0):
+        """Adding scores of a batch of samples from
+        a subject; the local indices are their 
+        positions in the pool of that subject
+        """
+
+        scores = np.array(scores, dtype=float)
+        keys = scores if self.key is None \
+               else np.asarray(self.key(scores), dtype=float)
+
+        self.keys = np.concatenate((self.keys, keys))
+        self.scores = np.concatenate((self.scores, scores))
+        self.subjects = np.concatenate((
+            self.subjects, subject*np.ones(len(scores), dtype=int)))
+        self.local_inds = np.concatenate((
+            self.local_inds, np.array(local_inds, dtype=int)))
+
+        if len(self.keys)>self.B:
+            keep = self.ranking()[:self.B]
+            self.keys = self.keys[keep]
+            self.scores = self.scores[keep]
+            self.subjects = self.subjects[keep]
+            self.local_inds = self.local_inds[keep]
+
+    def ranking(self):
+        """Ordering (part of) the buffer by the keys,
+        such that its first `B` elements are the best
+        ones
+        """
+
+        if len(self.keys)<=self.B:
+            cands = np.arange(len(self.keys))
+        elif self.B==0:
+            return np.zeros(0, dtype=int)
+        else:
+            # only keys not larger than the B-th
+            # smallest one need to be sorted (NaN
+            # keys, if any, go to the end)
+            thr = np.partition(self.keys, self.B-1)[self.B-1]
+            cands = np.where(~(self.keys>thr))[0]
+        order = np.lexsort((self.local_inds[cands],
+                            self.subjects[cands],
+                            self.keys[cands]))
+
+        return cands[order]
+
+    def result(self):
+        """Local indices of the selected samples, and
+        their scores, as lists with one array per 
+        subject (in the order of their ranking)
+        """
+
+        order = self.ranking()
+        subjects = self.subjects[order]
+        sel_inds = [self.local_inds[order][subjects==i]
+                    for i in range(self.n_subjects)]
+        sel_scores = [self.scores[order][subjects==i]
+                      for i in range(self.n_subjects)]
+
+        return sel_inds, sel_scores
+
+
+class PatchBank(object):
+    """Class of pre-extracted and normalized
+    patches of a set of voxels of one image,
+    stored in memory-mapped `.npy` files
+
+    The bank consists of the (raveled) voxel 
+    indices in `<name>_inds.npy` and their 
+    patches in `<name>_patches.npy`, with the
+    same order. Requested voxels are located in
+    the bank by a binary search; the number of
+    found and missing voxels are kept in `hits`
+    and `misses` (only the missing ones have to
+    be extracted from the images).
+    """
+
+    def __init__(self, inds_path, patches_path):
+
+        self.inds = np.load(inds_path)
+        self.sorter = np.argsort(self.inds, kind='mergesort')
+        self.patches = np.load(patches_path, mmap_mode='r')
+        self.paths = [inds_path, patches_path]
+        self.hits = 0
+        self.misses = 0
+
+    def locate(self, vox_inds):
+        """Rows of the given voxels in the bank, and
+        a mask showing which of them are found
+        """
+
+        vox_inds = np.array(vox_inds, dtype=int)
+        if len(self.inds)==0:
+            return (np.zeros(len(vox_inds), dtype=int),
+                    np.zeros(len(vox_inds), dtype=bool))
+        locs = np.searchsorted(self.inds, vox_inds,
+                               sorter=self.sorter)
+        locs[locs==len(self.inds)] = 0
+        rows = self.sorter[locs]
+        found = self.inds[rows]==vox_inds
+
+        return rows, found
+
+    def get_patches(self, vox_inds):
+        """Patches of the given voxels together with
+        a mask showing which of them are found in the
+        bank; patches of the missing voxels are left
+        zero to be filled by the caller
+        """
+
+        rows, found = self.locate(vox_inds)
+        self.hits += np.sum(found)
+        self.misses += np.sum(~found)
+
+        # reading the rows in the order they 
+        # are stored on the disk
+        found_locs = np.where(found)[0]
+        order = found_locs[np.argsort(rows[found_locs])]
+        patches = np.zeros((len(rows),)+self.patches.shape[1:],
+                           dtype=np.float32)
+        patches[order] = self.patches[rows[order]]
+
+        return patches, found
+
+    @property
+    def nbytes(self):
+        """Disk footprint of the bank
+        """
+        return np.sum([os.path.getsize(path) 
+                       for path in self.paths])
+
+    def report(self):
+        
+        total = self.hits + self.misses
+        rate = self.hits/float(total) if total>0 else 0.
+        print('Patch bank %s: %.1f MB on disk, hit rate: %.3f (%d/%d)'%
+              (self.paths[1], self.nbytes/2.**20, rate,
+               self.hits, total))
+
+        return rate
 
 def locate_in_dict(inds_dict, 
                    inds):
@@ -1015,7 +1678,7 @@ def get_mean_var(batches,
     # get the largest intensity
     max_i = 0
     for path in list(inds_dict.keys()):
-        img,_ = nrrd.read(path)
+        img = load_padded_volume(path)
         if img.max() > max_i:
             max_i = img.max()
             
@@ -1109,6 +1772,99 @@ def get_patches(imgs,
     are assumed to be un-adjusted, that is based
     on the original image shapes, and not the
     padded ones
+
+    All patches of the batch are gathered at
+    once from a strided window view of each
+    modality (see `get_patch_windows`); the
+    output is the same as the voxel-by-voxel
+    loop in `get_patches_loop`
+    """
+    
+    # dimensions of the outpuit patches
+    d1,d2,d3 = patch_shape
+    m = len(imgs)
+
+    # padding the image with radii
+    rads = np.zeros(3,dtype=int)
+    for i in range(3):
+        rads[i] = int((patch_shape[i]-1)/2.)
+    if not padded:
+        # if not already padded, do it
+        padded_imgs = []
+        for img in imgs:
+            padded_img = np.pad(
+                img, 
+                ((rads[0],rads[0]),
+                 (rads[1],rads[1]),
+                 (rads[2],rads[2])),
+                'constant')
+            padded_imgs += [padded_img]
+        # store the original shape
+        orig_shape = imgs[0].shape
+    else:
+        padded_imgs = imgs[:]
+        # adjust the shapes to go back
+        # to the original shape
+        pad_shape = imgs[0].shape
+        orig_shape = (pad_shape[0]-2*rads[0],
+                      pad_shape[1]-2*rads[1],
+                      pad_shape[2]-2*rads[2])
+    
+    multinds = np.unravel_index(inds, 
+                                orig_shape)
+    b = len(inds)
+    patches = np.zeros((b,d1,d2,m*d3))
+    for j in range(m):
+        # the window starting at a voxel of the
+        # padded image is the patch centered at
+        # the same (un-adjusted) voxel
+        windows = get_patch_windows(
+            padded_imgs[j], patch_shape)
+        patches[:,:,:,j*d3:(j+1)*d3] = windows[
+            multinds]
+        
+    # if the mask is also given, output 
+    # the corresponding labels too
+    if mask is not None:
+        labels = mask[multinds]
+        return patches, labels
+
+    return patches
+
+def get_patch_windows(padded_img, patch_shape):
+    """Read-only strided view of all patches of
+    a padded 3D image
+
+    The output has shape `(s1, s2, s3, d1, d2, d3)`
+    where `(s1,s2,s3)` is the shape of the original
+    (un-padded) image and `(d1,d2,d3)` is the patch
+    shape, such that element `[x,y,z]` of the view
+    is the patch centered at voxel `(x,y,z)` of the
+    original image. No data is copied.
+    """
+
+    patch_shape = tuple(patch_shape)
+    view_shape = tuple(
+        padded_img.shape[i]-patch_shape[i]+1
+        for i in range(3)) + patch_shape
+
+    return np.lib.stride_tricks.as_strided(
+        padded_img,
+        shape=view_shape,
+        strides=padded_img.strides*2,
+        writeable=False)
+
+def get_patches_loop(imgs, 
+                     inds, 
+                     patch_shape,
+                     padded=True,
+                     mask=None):
+    """Voxel-by-voxel version of `get_patches`
+    
+    This is the original implementation of
+    patch extraction, which is kept only as a
+    reference for validating and benchmarking
+    `get_patches` (see `benchmark_get_patches`)
     """
     
     # dimensions of the outpuit patches
@@ -1172,6 +1928,46 @@ def get_patches(imgs,
 
     return patches
 
+def benchmark_get_patches(imgs,
+                          inds,
+                          patch_shape,
+                          padded=True,
+                          reps=3):
+    """Timing `get_patches` against the loop in
+    `get_patches_loop` over a given set of indices,
+    after checking that both give identical 
+    patches
+
+    The output is a tuple of best running times
+    (in seconds) of the loop and the vectorized
+    extraction, respectively.
+    """
+
+    ref_patches = get_patches_loop(
+        imgs, inds, patch_shape, padded)
+    patches = get_patches(
+        imgs, inds, patch_shape, padded)
+    if not(ref_patches.tobytes()==patches.tobytes()):
+        raise ValueError(
+            "Vectorized patches are different "+
+            "from the reference ones.")
+
+    times = []
+    for func in [get_patches_loop, get_patches]:
+        best = np.inf
+        for t in range(reps):
+            t1 = time.time()
+            func(imgs, inds, patch_shape, padded)
+            best = min(best, time.time()-t1)
+        times += [best]
+
+    print('%d patches of shape %s: '% (
+        len(inds), str(tuple(patch_shape)))+
+          'loop %.4fs, vectorized %.4fs (x%.1f)'% (
+              times[0], times[1], times[0]/times[1]))
+
+    return tuple(times)
+
 def get_patches_multimg(all_padded_imgs,
                         img_inds,
                         patch_shape,
@@ -0,0 +1,149 @@
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def normalize_features(F):
+    """Unit-norm float32 copies of feature vectors
+    given as the columns of `F`, returned as the
+    rows of the output (zero vectors are kept zero)
+
+    All the functions of this module take the
+    features in this format, hence the norms are
+    computed only once per feature vector.
+    """
+
+    X = np.array(F, dtype=np.float32).T
+    norms = np.sqrt(np.sum(X**2, axis=1))
+    norms[norms==0] = 1.
+    X /= norms[:,np.newaxis]
+
+    return X
+
+
+def get_row_blocks(n_rows, n_cols, max_bytes, n_threads):
+    """Dividing rows of a similarity matrix into
+    blocks such that the blocks of all the threads
+    together take at most `max_bytes` bytes
+    """
+
+    b = max(1, int(max_bytes / (4*max(n_cols,1)*n_threads)))
+    return [np.arange(t, min(t+b, n_rows))
+            for t in range(0, n_rows, b)]
+
+
+def cosine_sims(X, Y=None):
+    """Full matrix of cosine similarities between
+    the rows of `X` and the rows of `Y` (or `X`
+    itself if `Y` is not given), all normalized
+    by `normalize_features`
+
+    Use `reduce_sims` if only a reduction of the
+    rows of this matrix is needed.
+    """
+
+    if Y is None:
+        Y = X
+
+    return np.dot(X, Y.T)
+
+
+def reduce_sims(X,
+                Y=None,
+                reduction='max',
+                k=1,
+                exclude_self=False,
+                max_bytes=2**28,
+                n_threads=1):
+    """Reducing rows of the matrix of cosine
+    similarities between the rows of `X` and `Y`
+    (see `cosine_sims`) without forming the whole
+    matrix
+
+    Blocks of rows of the similarity matrix are
+    computed by matrix products (BLAS GEMM), possibly
+    in a pool of threads, and each one is reduced
+    right away.
+
+    :Parameters:
+
+        **X**, **Y** : 2D float32 arrays
+            normalized features (as rows); if `Y`
+            is not given, similarities of `X` to
+            itself are computed
+
+        **reduction** : string (default: `'max'`)
+            one of the following reductions of each
+            row:
+
+            - `'max'`: the maximum similarity
+            - `'argmax'`: the maximum similarity and
+              its index (column)
+            - `'topk'`: the `k` largest similarities
+              and their indices, sorted in a
+              descending order
+
+        **exclude_self** : boolean (default: False)
+            if True (and `Y` is not given), the
+            similarity of each sample to itself will
+            be ignored
+
+        **max_bytes** : integer
+            maximum memory taken by the similarity
+            blocks of all the threads
+
+        **n_threads** : integer (default: 1)
+            number of threads, each computing its own
+            blocks; since BLAS already parallelizes
+            each matrix product, more than one thread
+            is only useful with a single-threaded BLAS
+    """
+
+    if reduction not in ['max', 'argmax', 'topk']:
+        raise ValueError('Reduction should be either ' +
+                         "'max', 'argmax' or 'topk'.")
+    if reduction=='topk' and k<1:
+        raise ValueError('At least one similarity should ' +
+                         'be kept in each row.')
+    self_sims = Y is None
+    if self_sims:
+        Y = X
+    n = X.shape[0]
+    k = min(k, Y.shape[0])
+
+    if reduction=='topk':
+        vals = np.zeros((n,k), dtype=np.float32)
+        inds = np.zeros((n,k), dtype=int)
+    else:
+        vals = np.zeros(n, dtype=np.float32)
+        inds = np.zeros(n, dtype=int)
+
+    def reduce_block(rows):
+        sims = np.dot(X[rows], Y.T)
+        if self_sims and exclude_self:
+            sims[np.arange(len(rows)), rows] = -np.inf
+        if reduction=='max':
+            vals[rows] = np.max(sims, axis=1)
+        elif reduction=='argmax':
+            inds[rows] = np.argmax(sims, axis=1)
+            vals[rows] = sims[np.arange(len(rows)), inds[rows]]
+        else:
+            top = np.argpartition(-sims, k-1, axis=1)[:,:k]
+            top_vals = np.take_along_axis(sims, top, axis=1)
+            order = np.argsort(-top_vals, axis=1, kind='mergesort')
+            inds[rows] = np.take_along_axis(top, order, axis=1)
+            vals[rows] = np.take_along_axis(top_vals, order, axis=1)
+
+    blocks = get_row_blocks(n, Y.shape[0], max_bytes, n_threads)
+    if n_threads>1 and len(blocks)>1:
+        with ThreadPoolExecutor(n_threads) as pool:
+            # (re-raising errors of the threads, if any)
+            list(pool.map(reduce_block, blocks))
+    else:
+        for rows in blocks:
+            reduce_block(rows)
+
+    if reduction=='max':
+        return vals
+    else:
+        return vals, inds